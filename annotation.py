@@ -1,3 +1,5 @@
+import re
+
 class htmlStyle:
     """
     HTML Styling for Query Plan Annotations
@@ -24,262 +26,415 @@ def italic(string):
 def blueItalicBold(string):
     return blue(italic(bold(string)))
 
+def clean(expression):
+    """
+    Removes the ::text casts of an expression, ::text is unlimited char in postgresql
+    :param expression: condition, filter or key printed by EXPLAIN
+    :return: expression without casts to text
+    """
+    return expression.replace("::text", "")
+
+def operatorCost(qep):
+    """
+    Cost of a node without the cost of its inputs. Init plans and sub plans are not inputs of the node.
+    :param qep: plan node
+    :return: total cost of the node minus the total cost of its child nodes
+    """
+    cost = qep["Total Cost"]
+    for child in qep.get("Plans", ()):
+        if child.get("Parent Relationship") not in ("InitPlan", "SubPlan"):
+            cost -= child["Total Cost"]
+    return cost
+
+def template(text):
+    """
+    Compiles an annotation template. Fields are written as {name} or {name:spec} and compiled into a printf-style
+    format, filled in with the % operator and a tuple of values in the order of the fields.
+    :param text: template text
+    :return: format string
+    """
+    return re.sub(r"\{\w+(?::([^}]*))?\}", lambda m: "%" + (m.group(1) or "s"), text.replace("%", "%%"))
+
+########################### TEMPLATES ############################
+# The styling is applied once, when the module is loaded, so an annotation is a single % operation.
+# Node values are only passed as arguments, they are never parsed as templates.
+OPERATION = blueItalicBold("{type}")
+SCAN_HEAD = template(OPERATION + " is done on " + blue("{relation}") + " with a cost of " + bold("{cost}") + ". ")
+SCAN_CHEAPER = template(OPERATION + " is chosen as it is more efficient than " + italic("{other}") + ", which costs {ratio:.3f} times more with a cost of {value} in the AQP. ")
+JOIN_HEAD = template(OPERATION + " is done on " + bold("{cond}") + " with a cost of " + bold("{cost}") + ". ")
+JOIN_CHEAPER = template(OPERATION + " is chosen as it is more efficient than " + italic("{other}") + ", which costs {ratio:.3f} times more with a cost of {value:.3f} in the AQP. ")
+CONDITION = template(" Condition found: " + blue("{cond}."))
+FILTER = template(" There is further refinement on the record with these filter " + bold("{filter}") + ".")
+DEFAULT = template("The " + OPERATION + " operation is executed.")
+BITMAP_HEAP = template("The Bitmap Heap Scan takes a row location bitmap generated by a Bitmap Index Scan and looks up the relevant data.")
+BITMAP_RECHECK = template(" Rows of lossy bitmap pages are rechecked with the condition " + blue("{cond}") + ".")
+BITMAP_INDEX = template("The " + OPERATION + " operation scans the index " + bold("{index}") + " and builds a bitmap of the locations of the matching rows.")
+BITMAP_COMBINE = template("The " + OPERATION + " operation combines the bitmaps of its sub-operations into a single row location bitmap.")
+HASHAGG = template("With " + OPERATION + " function, the DBMS hashes the query rows into memory, for use by its parent operation.")
+HASHJOIN = template("The " + OPERATION + " joins the results from the previous operations by using an " + bold("{join}") + " " + bold("Join"))
+HASHJOIN_COND = template(" on the condition: " + blue("{cond}"))
+HASH = template("The " + OPERATION + " operation hashes the query rows into memory, for use by its parent operation.")
+INDEX = template("With " + OPERATION + " operation, the DBMS is scanning the row in specified range of index.")
+INDEXONLY = template("With " + OPERATION + " operation, the DBMS is scanning the row using an index table " + bold("{index}"))
+INDEXONLY_COND = template(" with condition " + blue("{cond}"))
+INDEXONLY_FILTER = template(" The result will then be filtered by " + bold("{filter}") + ".")
+TIDSCAN = template("The " + OPERATION + " operation fetches the rows of " + blue("{relation}") + " directly by their tuple identifiers.")
+MERGEJOIN = template("The operation " + OPERATION + " joins the sorted results using join keys from sub-operations")
+MERGEJOIN_COND = template(" with condition " + blue("{cond}"))
+SEMI_JOIN = template(" results only returns records from the left relation")
+NESTLOOP = template("The operation " + OPERATION + " performs a join or search. For every row the first child produces, the corresponding node will be looked up in the second node.")
+SEQSCAN = template("The operation " + OPERATION + " operation performs a sequential scan on the relation ")
+ALIAS = template(" has alias named " + red("{alias}"))
+SEQSCAN_FILTER = template(" will be filtered with the condition " + bold("{filter}"))
+SORT = template("The " + OPERATION + " operation performs a sort on the rows ")
+SORT_DESC = template(blue("{keys}") + " in descending order")
+SORT_ASC = template(red("{keys}") + " in ascending order")
+SORT_KEYS = template("based on " + bold("{keys}"))
+SORT_PRESORTED = template(", reusing the order of the input on " + bold("{keys}"))
+COST = template(" with a cost of " + bold("{cost}") + ".")
+GATHERMERGE = template("The " + OPERATION + " operation indicates that each process executing the parallel portion of the plan is producing tuples in sorted order, and the leader is performing an order-preserving merge.")
+GATHER = template("The " + OPERATION + " operation reads tuples from the background workers processes in whatever order is convenient, destroying any sort order that may have existed.")
+LIMIT = template("With the " + OPERATION + " operation, the DBMS takes only " + bold("{rows}") + " records and disregards the rest.")
+AGGREGATE = template("The " + OPERATION + " operation is used to perform aggregate operations on single results from multiple input rows.")
+GROUP_KEYS = template(" The tuples are aggregated by {keys} group keys.")
+MATERIALIZE = template("The " + OPERATION + " operation stores the rows of its sub-operation in memory, so that they can be read again without being computed again.")
+MEMOIZE = template("The " + OPERATION + " operation caches the rows of its sub-operation by " + bold("{key}") + ", so that lookups repeating a key are answered from the cache.")
+APPEND = template("The " + OPERATION + " operation concatenates the rows of its " + bold("{count}") + " sub-operations.")
+MERGEAPPEND = template("The " + OPERATION + " operation merges the sorted rows of its " + bold("{count}") + " sub-operations, keeping them ordered by " + bold("{keys}") + ".")
+CTESCAN = template("The " + OPERATION + " operation reads the rows of the common table expression " + blue("{cte}"))
+SUBQUERYSCAN = template("The " + OPERATION + " operation reads the rows of the subquery " + blue("{alias}"))
+FUNCTIONSCAN = template("The " + OPERATION + " operation reads the rows returned by the function " + blue("{function}"))
+VALUESSCAN = template("The " + OPERATION + " operation reads the rows of a VALUES list")
+RESULT = template("The " + OPERATION + " operation computes its rows without scanning a relation.")
+ONE_TIME_FILTER = template(" Its rows are only produced if " + bold("{filter}") + " holds.")
+UNIQUE = template("The " + OPERATION + " operation removes duplicate rows from its sorted input.")
+GROUP = template("The " + OPERATION + " operation groups its sorted input by {keys}.")
+WINDOWAGG = template("The " + OPERATION + " operation computes window functions over the rows of its sub-operation.")
+SETOP = template("The " + OPERATION + " operation computes the " + bold("{command}") + " of the rows of its sub-operations.")
+ACTUAL = template(" Measured " + bold("{time:.3f} ms") + " over {loops} loops, returning " + bold("{rows}") + " rows against {estimate} estimated")
+ACTUAL_ERROR = template(", the estimate is {error:.1f} times too {direction}")
+ACTUAL_BUFFERS = template(". Shared buffers: {hit} hit, {read} read.")
+NEVER_EXECUTED = template(" The node was never executed.")
+MEASURED = template(bold("{time:.3f} ms") + " execution and {planning:.3f} ms planning, with an estimated cost of " + bold("{cost}") + ".")
+MEASURED_RATIO = template(" Its estimated cost is {cost:.3f} times the cost of the QEP and it ran {time:.3f} times as long.")
+MISRANKED = red(" The estimate ranks the plans the wrong way round.")
+
+########################### DISPATCH TABLE ############################
+# How every node type is summarized and annotated, shared by QueryAnalyzer.processPlans and generateQueryPlan.
+# Scans are compared per relation and joins per join condition with the AQPs, sorts are labelled by their sort
+# key and every other node by its type. Node types missing from the table are annotated by defaultAnno.
+SCAN_NODE, JOIN_NODE, SORT_NODE, OTHER_NODE = "scan", "join", "sort", "other"
+NODE_TYPES = {
+    "Seq Scan": (SCAN_NODE, "seqscanAnno"),
+    "Index Scan": (SCAN_NODE, "indexAnno"),
+    "Index Only Scan": (SCAN_NODE, "indexonlyAnno"),
+    "Bitmap Heap Scan": (SCAN_NODE, "bitmapAnno"),
+    "Tid Scan": (SCAN_NODE, "tidscanAnno"),
+    "Tid Range Scan": (SCAN_NODE, "tidscanAnno"),
+    "Sample Scan": (SCAN_NODE, "defaultAnno"),
+    "Bitmap Index Scan": (OTHER_NODE, "bitmapindexAnno"),
+    "BitmapAnd": (OTHER_NODE, "bitmapcombineAnno"),
+    "BitmapOr": (OTHER_NODE, "bitmapcombineAnno"),
+    "Hash Join": (JOIN_NODE, "hashjoinAnno"),
+    "Merge Join": (JOIN_NODE, "mergejoinAnno"),
+    "Nested Loop": (OTHER_NODE, "nestloopAnno"),
+    "Hash": (OTHER_NODE, "hashAnno"),
+    "Sort": (SORT_NODE, "sortAnno"),
+    "Incremental Sort": (SORT_NODE, "sortAnno"),
+    "Gather Merge": (OTHER_NODE, "gathermergeAnno"),
+    "Gather": (OTHER_NODE, "gatherAnno"),
+    "Limit": (OTHER_NODE, "limitAnno"),
+    "Aggregate": (OTHER_NODE, "aggregateAnno"),
+    "Group": (OTHER_NODE, "groupAnno"),
+    "WindowAgg": (OTHER_NODE, "windowaggAnno"),
+    "Unique": (OTHER_NODE, "uniqueAnno"),
+    "SetOp": (OTHER_NODE, "setopAnno"),
+    "Materialize": (OTHER_NODE, "materializeAnno"),
+    "Memoize": (OTHER_NODE, "memoizeAnno"),
+    "Append": (OTHER_NODE, "appendAnno"),
+    "Merge Append": (SORT_NODE, "mergeappendAnno"),
+    "CTE Scan": (OTHER_NODE, "ctescanAnno"),
+    "Subquery Scan": (OTHER_NODE, "subqueryscanAnno"),
+    "Function Scan": (OTHER_NODE, "functionscanAnno"),
+    "Values Scan": (OTHER_NODE, "valuesscanAnno"),
+    "Result": (OTHER_NODE, "resultAnno")
+}
+# join node type -> key of its join condition
+JOIN_CONDITIONS = {"Hash Join": "Hash Cond", "Merge Join": "Merge Cond"}
+UNKNOWN_NODE = (OTHER_NODE, "defaultAnno")
+
 class Annotation:
     """
     Annotations for query plan
     """
     def __init__(self):
-        self.annoDict = {
-        "Bitmap Heap Scan": self.bitmapAnno,
-        "Hash Agg": self.hashaggAnno,
-        "Hash Join": self.hashjoinAnno,
-        "Hash": self.hashAnno,
-        "Index Scan": self.indexAnno,
-        "Index Only Scan": self.indexonlyAnno,
-        "Merge Join": self.mergejoinAnno,
-        "Nested Loop": self.nestloopAnno,
-        "Seq Scan": self.seqscanAnno,
-        "Sort": self.sortAnno,
-        "Gather Merge": self.gathermergeAnno,
-        "Gather": self.gatherAnno,
-        "Limit": self.limitAnno,
-        "Aggregate": self.aggregateAnno
-        }
+        # node type -> (kind, bound annotation method), resolved once from NODE_TYPES
+        self.dispatch = {nodeType: (kind, getattr(self, name)) for nodeType, (kind, name) in NODE_TYPES.items()}
+        self.unknown = (OTHER_NODE, self.defaultAnno)
+
+    def annotate(self, qep, scanDict, joinDict):
+        """
+        Annotates a single node of a QEP, comparing its scans and joins with the AQPs
+        :param qep: plan node
+        :param scanDict: Minimum cost of every scan type in the AQPs, per relation
+        :param joinDict: Minimum cost of every join type in the AQPs, per join condition
+        :return: label of the node, annotation string
+        """
+        nodeType = qep["Node Type"]
+        kind, procedure = self.dispatch.get(nodeType, self.unknown)
+        if kind == SCAN_NODE and qep.get("Relation Name") in scanDict:
+            return qep["Relation Name"].upper() + " table", self.compareScanAnno(qep, scanDict)
+        if kind == JOIN_NODE:
+            joinCond = qep.get(JOIN_CONDITIONS[nodeType])
+            if joinCond in joinDict:
+                return joinCond, self.compareJoinAnno(qep, joinDict, joinCond)
+        if kind == SORT_NODE:
+            return ", ".join(qep["Sort Key"]), procedure(qep)
+        return nodeType, procedure(qep)
 
     ########################### HIGH LEVEL ANNOTATIONS ############################
     def compareScanAnno(self, qep, scanDict):
         """
         Scan annotations and compares QEP will all other relevant AQPs
         :param qep: Query Execution Plan
-        :param scanDict: Dictionary of Alternative Scans in AQPs
+        :param scanDict: Minimum cost of every scan type in the AQPs, per relation
         :return: annotation string
         """
-        key = qep["Relation Name"]
-        possible = scanDict[key]
-        seen = {}
-        for j in possible:
-            if j["Node Type"] not in seen:
-                seen[j["Node Type"]] = j["Total Cost"]
-            elif j["Node Type"] in seen and seen[j["Node Type"]] > j["Total Cost"]:
-                seen[j["Node Type"]] = j["Total Cost"]
-        seen[qep["Node Type"]] = qep["Total Cost"]
-
-        result = ""
-        result += f"{blueItalicBold(qep['Node Type'])} is done on {blue(qep['Relation Name'])} with a cost of {bold(str(qep['Total Cost']))}. "
-        for key, value in seen.items():
-            if key != qep["Node Type"]:
-                ratio = value/seen[qep['Node Type']]
+        nodeType, cost = qep["Node Type"], qep["Total Cost"]
+        result = [SCAN_HEAD % (nodeType, qep["Relation Name"], cost)]
+        for key, value in scanDict[qep["Relation Name"]].items():
+            if key != nodeType:
+                ratio = value / cost if cost else float("inf")
                 if ratio >= 1:
-                    result += f"{blueItalicBold(qep['Node Type'])} is chosen as as it is more efficient than {italic(key)}, which costs {ratio:.3f} times more with a cost of {value} in the AQP. "
-        if qep["Node Type"] == "Index Scan":
-            result += self.indexAnno(qep)
-        elif qep["Node Type"] == "Index Only Scan":
-            result += self.indexonlyAnno(qep)
-        elif qep["Node Type"] == "Seq Scan":
-            result += self.seqscanAnno(qep)
-        elif qep["Node Type"] == "Bitmap Heap Scan":
-            result += self.bitmapAnno(qep)
-        return result
+                    result.append(SCAN_CHEAPER % (nodeType, key, ratio, value))
+        result.append(self.dispatch[nodeType][1](qep))
+        return "".join(result)
 
     def compareJoinAnno(self, qep, joinDict, joinCond):
         """
         Join annotations and compares QEP will all other relevant AQPs
         :param qep: Query Execution Plan
-        :param scanDict: Dictionary of Alternative Scans in AQPs
+        :param joinDict: Minimum cost of every join type in the AQPs, per join condition
         :param joinCond: Join condition
         :return: annotation string
         """
-        possible = joinDict[joinCond]
-        seen = {}
-        for j in possible:
-            if j["Node Type"] not in seen:
-                seen[j["Node Type"]] = j["Total Cost"]
-            elif j["Node Type"] in seen and seen[j["Node Type"]] > j["Total Cost"]:
-                seen[j["Node Type"]] = j["Total Cost"]
-        # seen[qep["Node Type"]] = qep["Total Cost"] - qep["Plans"][0]["Total Cost"] - qep["Plans"][1]["Total Cost"]
-
-        joinCost = qep['Total Cost'] - qep["Plans"][0]["Total Cost"] - qep["Plans"][1]["Total Cost"]
-        joinCost = round(joinCost, 3)
-        result = ""
-        result += f"{blueItalicBold(qep['Node Type'])} is done on {bold(joinCond)} with a cost of {bold(str(joinCost))}. "
-        for key, value in seen.items():
-            if key != qep["Node Type"]:
-                ratio = value/joinCost
+        nodeType = qep["Node Type"]
+        joinCost = round(operatorCost(qep), 3)
+        result = [JOIN_HEAD % (nodeType, joinCond, joinCost)]
+        for key, value in joinDict[joinCond].items():
+            if key != nodeType:
+                ratio = value / joinCost if joinCost else float("inf")
                 if ratio >= 1:
-                    result += f"{blueItalicBold(qep['Node Type'])} is chosen as it is more efficient than {italic(key)}, which costs {value/joinCost:.3f} times more with a cost of {value:.3f} in the AQP. "
-        
-        if qep["Node Type"] == "Hash Join":
-            result += self.hashjoinAnno(qep)
-        elif qep["Node Type"] == "Merge Join":
-            result += self.mergejoinAnno(qep)
+                    result.append(JOIN_CHEAPER % (nodeType, key, ratio, value))
+        result.append(self.dispatch[nodeType][1](qep))
+        return "".join(result)
 
+    ########################### SPECIFIC ANNOTATIONS ############################
+    def conditionAnno(self, qep):
+        result = ""
+        if "Index Cond" in qep:
+            result += CONDITION % clean(qep["Index Cond"])
+        if "Filter" in qep:
+            result += FILTER % clean(qep["Filter"])
         return result
 
-    ########################### SPECIFIC ANNOTATIONS ############################
     def defaultAnno(self, qep):
-        result = f"The {blueItalicBold(qep['Node Type'])} operation is executed."
-
-        if "indexCond" in qep:
-            result = result + " Condition found: " + blue(qep["indexCond"].replace('::text','') + ".") #::text is unlimited char in postgresql
-
-        if "filter" in qep:
-            result = result + f" There is further refinement on the record with these filter {bold(qep['filter'].replace('::text',''))}."
-
-        return result
+        return DEFAULT % qep["Node Type"] + self.conditionAnno(qep)
 
     def bitmapAnno(self, qep):
-        result = "The Bitmap Heap Scan takes a row location bitmap generated by a Bitmap Index Scan and looks up the relevant data."
+        result = BITMAP_HEAP
+        if "Recheck Cond" in qep:
+            result += BITMAP_RECHECK % clean(qep["Recheck Cond"])
         return result
 
-    def hashaggAnno(self, qep):
-        result = f"With {blueItalicBold(qep['Node Type'])} function, the DBMS hashes the query rows into memory, for use by its parent operation."
-        
-        return result
+    def bitmapindexAnno(self, qep):
+        return BITMAP_INDEX % (qep["Node Type"], qep["Index Name"]) + self.conditionAnno(qep)
 
-    def hashjoinAnno(self, qep):
-        result = f"The {blueItalicBold(qep['Node Type'])} joins the results from the previous operations by using an {bold(qep['Join Type'])} {bold('Join')}"
+    def bitmapcombineAnno(self, qep):
+        return BITMAP_COMBINE % qep["Node Type"]
 
-        if "Hash Join" in qep:
-            result += f" on the condition: {blue(qep['Hash Cond'].replace('::text', ''))}"
+    def hashaggAnno(self, qep):
+        return HASHAGG % qep["Node Type"]
 
-        result += "."
-        return result
+    def hashjoinAnno(self, qep):
+        result = HASHJOIN % (qep["Node Type"], qep["Join Type"])
+        if "Hash Cond" in qep:
+            result += HASHJOIN_COND % clean(qep["Hash Cond"])
+        return result + "."
 
     def hashAnno(self, qep):
-        result = f"The {blueItalicBold(qep['Node Type'])} operation hashes the query rows into memory, for use by its parent operation."
-        return result
+        return HASH % qep["Node Type"]
 
     def indexAnno(self, qep):
         #Default mentioning type of scan and definition
-        result = f"With {blueItalicBold(qep['Node Type'])} operation, the DBMS is scanning the row in specified range of index."
-
-        if "indexCond" in qep:
-            result = result + " Condition found: " + blue(qep["indexCond"].replace('::text','') + ".") #::text is unlimited char in postgresql
-
-        if "filter" in qep:
-            result = result + f" There is further refinement on the record with these filter {bold(qep['filter'].replace('::text',''))}."
-
-        return result
+        return INDEX % qep["Node Type"] + self.conditionAnno(qep)
 
     def indexonlyAnno(self, qep):
-
-        result = f"With {blueItalicBold(qep['Node Type'])} operation, the DBMS is scanning the row using an index table {bold(qep['Index Name'])}"
-
-        if "indexCond" in qep:
-            result += " with condition" + blue(
-                qep["indexCond"].replace("::text", "")
-            )
-
+        result = INDEXONLY % (qep["Node Type"], qep["Index Name"])
+        if "Index Cond" in qep:
+            result += INDEXONLY_COND % clean(qep["Index Cond"])
         # Obtain the filtered attribute and remove unnecessary strings
         if "Filter" in qep:
-            result += f" The result will then be filtered by {bold(qep['Filter'].replace('::text', ''))}."
-
+            result += INDEXONLY_FILTER % clean(qep["Filter"])
         return result
 
-    def mergejoinAnno(self, qep):
-
-        result = f"The operation {blueItalicBold(qep['Node Type'])} joins the sorted results using join keys from sub-operations"
-
-        if "Merge Join" in qep:
-            result += " with condition " + blue(
-                qep["Merge Join"].replace("::text", "")
-            )
+    def tidscanAnno(self, qep):
+        return TIDSCAN % (qep["Node Type"], qep["Relation Name"])
 
+    def mergejoinAnno(self, qep):
+        result = MERGEJOIN % qep["Node Type"]
+        if "Merge Cond" in qep:
+            result += MERGEJOIN_COND % clean(qep["Merge Cond"])
         # Checking join type
-        if "Join Type" == "Semi":
-            result += " results only returns records from the left relation"
-
-        result += "."
-
-        return result
+        if qep.get("Join Type") == "Semi":
+            result += SEMI_JOIN
+        return result + "."
 
     def nestloopAnno(self, qep):
-
-        result = f"The operation {blueItalicBold(qep['Node Type'])} performs a join or search. For every row the first child produces, the corresponding node will be looked up in the second node."
-        return result
+        return NESTLOOP % qep["Node Type"]
 
     def seqscanAnno(self, qep):
-
-        result = f"The operation {blueItalicBold(qep['Node Type'])} operation performs a sequential scan on the relation "
-
+        result = SEQSCAN % qep["Node Type"]
         # Retrieve relation name from query input
         if "Relation Name" in qep:
             result += blue(qep["Relation Name"])
-
         # Retrieve the alias from query plan if there is an alternative name
-        if "Alias" in qep:
-            if qep["Relation Name"] != qep["Alias"]:
-                result += f" has alias named {red(qep['Alias'])}"
-
+        if "Alias" in qep and qep.get("Relation Name") != qep["Alias"]:
+            result += ALIAS % qep["Alias"]
         # Obtain the filtered attribute and remove unnecessary strings
         if "Filter" in qep:
-            result += f" will be filtered with the condition {bold(qep['Filter'].replace('::text', ''))}"
-
-        result += "."
-
-        return result
+            result += SEQSCAN_FILTER % clean(qep["Filter"])
+        return result + "."
 
     def sortAnno(self, qep):
+        keys = [clean(key) for key in qep["Sort Key"]]
+        result = SORT % qep["Node Type"]
+        # Keys sorted in descending or explicitly ascending order
+        if any(key.endswith((" DESC", " ASC")) for key in keys):
+            result += ", ".join(SORT_DESC % key[:-5] if key.endswith(" DESC") else
+                                SORT_ASC % key[:-4] if key.endswith(" ASC") else bold(key) for key in keys)
+        # Else specify the attribute
+        else:
+            result += SORT_KEYS % ", ".join(keys)
+        # Incremental Sort only sorts the rows that share the leading, already sorted keys
+        if "Presorted Key" in qep:
+            result += SORT_PRESORTED % clean(", ".join(qep["Presorted Key"]))
+        return result + COST % round(operatorCost(qep), 3)
 
-        result = (
-            f"The {blueItalicBold(qep['Node Type'])} operation performs a sort on the rows "
-        )
+    def gathermergeAnno(self, qep):
+        return GATHERMERGE % qep["Node Type"]
 
-        # If sorting in descending order
-        if "DESC" in qep["Sort Key"]:
-            result += (
-                blue(str(qep["Sort Key"].replace("DESC", "")))
-                + " in descending order"
-            )
+    def gatherAnno(self, qep):
+        return GATHER % qep["Node Type"]
 
-        # If sorting in ascending order
-        elif "ASC" in qep["Sort Key"]:
-            result += (
-                red(str(qep["Sort Key"].replace("ASC", "")))
-                + " in ascending order"
-            )
+    def limitAnno(self, qep):
+        return LIMIT % (qep["Node Type"], qep["Plan Rows"])
 
-        # Else specify the attribute
+    def aggregateAnno(self, qep):
+        if qep.get("Strategy") == "Hashed":
+            result = self.hashaggAnno(qep)
         else:
-            result += f"based on {bold(str(qep['Sort Key']))}"
-        
-        if len(qep["Plans"]) == 1:
-            qep_total_cost = qep["Total Cost"] - qep["Plans"][0]["Total Cost"]
-        elif len(qep["Plans"]) == 2:
-            qep_total_cost = qep["Total Cost"] - qep["Plans"][0]["Total Cost"] - qep["Plans"][1]["Total Cost"]
-            
-        qep_total_cost = round(qep_total_cost, 3)
-        result += f" with a cost of {bold(str(qep_total_cost))}."
+            result = AGGREGATE % qep["Node Type"]
+        if "Group Key" in qep:
+            result += GROUP_KEYS % ",".join(bold(clean(key)) for key in qep["Group Key"])
+        return result + self.conditionAnno(qep)
 
-        return result
+    def groupAnno(self, qep):
+        return GROUP % (qep["Node Type"], ",".join(bold(clean(key)) for key in qep.get("Group Key", ())))
 
-    def gathermergeAnno(self, qep):
+    def windowaggAnno(self, qep):
+        return WINDOWAGG % qep["Node Type"]
 
-        result = f"The {blueItalicBold(qep['Node Type'])} operation indicates that each process executing the parallel portion of the plan is producing tuples in sorted order, and the leader is performing an order-preserving merge."
+    def uniqueAnno(self, qep):
+        return UNIQUE % qep["Node Type"]
 
-        return result
+    def setopAnno(self, qep):
+        return SETOP % (qep["Node Type"], qep.get("Command", "set operation"))
 
-    def gatherAnno(self, qep):
+    def materializeAnno(self, qep):
+        return MATERIALIZE % qep["Node Type"]
 
-        result = f"The {blueItalicBold(qep['Node Type'])} operation reads tuples from the background workers processes in whatever order is convenient, destroying any sort order that may have existed."
+    def memoizeAnno(self, qep):
+        return MEMOIZE % (qep["Node Type"], clean(qep.get("Cache Key", "")))
 
-        return result
+    def appendAnno(self, qep):
+        return APPEND % (qep["Node Type"], self.inputs(qep))
 
-    def limitAnno(self, qep):
+    def mergeappendAnno(self, qep):
+        return MERGEAPPEND % (qep["Node Type"], self.inputs(qep), clean(", ".join(qep["Sort Key"])))
 
-        result = f"With the {blueItalicBold(qep['Node Type'])} operation, the DBMS takes only {bold(str(qep['Plan Rows']))} records and disregards the rest."
+    def ctescanAnno(self, qep):
+        result = CTESCAN % (qep["Node Type"], qep["CTE Name"])
+        if "Alias" in qep and qep["CTE Name"] != qep["Alias"]:
+            result += ALIAS % qep["Alias"]
+        return result + "." + self.conditionAnno(qep)
 
-        return result
+    def subqueryscanAnno(self, qep):
+        return SUBQUERYSCAN % (qep["Node Type"], qep.get("Alias", "")) + "." + self.conditionAnno(qep)
 
-    def aggregateAnno(self, qep):
-        result = f"The {blueItalicBold(qep['Node Type'])} operation is used to perform aggregate operations on single results from multiple input rows."
+    def functionscanAnno(self, qep):
+        return FUNCTIONSCAN % (qep["Node Type"], qep.get("Function Name", "")) + "." + self.conditionAnno(qep)
 
-        if "Group Key" in qep:
-            result += f" where the tuples are aggregated by "
+    def valuesscanAnno(self, qep):
+        return VALUESSCAN % qep["Node Type"] + "." + self.conditionAnno(qep)
 
-            for key in qep["Group Key"]:
-                result += bold(key) + ","
-            
-            result = result[:-1] + " group keys."
+    def resultAnno(self, qep):
+        result = RESULT % qep["Node Type"]
+        if "One-Time Filter" in qep:
+            result += ONE_TIME_FILTER % clean(qep["One-Time Filter"])
+        return result
 
-        return result
\ No newline at end of file
+    ########################### MEASURED ANNOTATIONS ############################
+    def actualAnno(self, qep):
+        """
+        Annotates a node measured with EXPLAIN (ANALYZE, BUFFERS) with its time, rows, buffers and row estimate error
+        :param qep: measured plan node
+        :return: annotation string
+        """
+        loops = qep.get("Actual Loops", 0)
+        if not loops:
+            return NEVER_EXECUTED
+        # times and rows are averages per loop
+        rows = round(qep["Actual Rows"] * loops)
+        estimate = round(qep["Plan Rows"] * loops)
+        result = ACTUAL % (qep["Actual Total Time"] * loops, loops, rows, estimate)
+        error = max(rows, 1) / max(estimate, 1)
+        if error >= 2:
+            result += ACTUAL_ERROR % (error, "low")
+        elif error <= 0.5:
+            result += ACTUAL_ERROR % (1 / error, "high")
+        return result + ACTUAL_BUFFERS % (qep.get("Shared Hit Blocks", 0), qep.get("Shared Read Blocks", 0))
+
+    def compareMeasuredAnno(self, measurements):
+        """
+        Compares the measured execution of the cheapest AQPs with the QEP
+        :param measurements: QueryAnalyzer.measurements, the QEP first
+        :return: list of (label, annotation string)
+        """
+        results = []
+        qep = measurements[0].get("plan") if measurements else None
+        for i, measured in enumerate(measurements):
+            changes = [", ".join(measured["off"]) + " off"] if measured["off"] else []
+            changes += [f"{setting}={value}" for setting, value in measured.get("settings", {}).items()]
+            label = "QEP" if i == 0 else "AQP with " + ", ".join(changes)
+            if "error" in measured:
+                results.append((label, red(measured["error"])))
+                continue
+            plan = measured["plan"]
+            result = MEASURED % (plan["Execution Time"], plan["Planning Time"], measured["cost"])
+            if i and qep is not None and measurements[0]["cost"] and qep["Execution Time"]:
+                costRatio = measured["cost"] / measurements[0]["cost"]
+                timeRatio = plan["Execution Time"] / qep["Execution Time"]
+                result += MEASURED_RATIO % (costRatio, timeRatio)
+                if (costRatio - 1) * (timeRatio - 1) < 0:
+                    result += MISRANKED
+            results.append((label, result))
+        return results
+
+    def inputs(self, qep):
+        """
+        Number of inputs of a node, without its init plans and sub plans
+        :param qep: plan node
+        :return: number of child nodes
+        """
+        return sum(child.get("Parent Relationship") not in ("InitPlan", "SubPlan") for child in qep.get("Plans", ()))
@@ -0,0 +1,118 @@
+import argparse
+import html
+import json
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import sqlparse
+
+from preprocessing import Database
+
+# markup of the annotations, which are written for the web pages
+TAG = re.compile(r"<[^>]+>")
+
+
+def load_queries(paths):
+    """Reads the SQL statements of files and directories. Directories contribute their .sql files in name order,
+    and every file may hold several statements separated by semicolons.
+
+    Args:
+        paths (list): Files and directories of SQL
+
+    Returns:
+        list: (id, query) pairs, the id being the file name followed by the statement number
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".sql"))
+        else:
+            files.append(path)
+    queries = []
+    for file in files:
+        with open(file) as f:
+            statements = [s for s in sqlparse.split(f.read()) if sqlparse.format(s, strip_comments=True).strip()]
+        for i, statement in enumerate(statements, 1):
+            queries.append((f"{file}#{i}", statement))
+    return queries
+
+
+def analyse(db, query_id, query):
+    """Analyses a query on a pooled connection with Database.analyse, the analysis of the JSON API.
+    The record holds the id of the query and the result of Database.analyse: the QEP, the distinct AQPs,
+    the per node records with the cost ratio of every compared alternative, the stage timings and the
+    counters. The annotations of the web pages are added as plain text.
+
+    Args:
+        db (Database): Shared database
+        query_id (str): Id of the query in the output
+        query (str): SQL query
+
+    Returns:
+        dict: JSON Lines record of the query
+    """
+    annotations = []
+
+    def keep_annotations(analyzer, outcome):
+        annotations.extend({"node": label, "text": html.unescape(TAG.sub("", text))}
+                           for label, text in analyzer.queryPlanList)
+
+    record = {"id": query_id, **db.analyse(query, keep_annotations)}
+    if record["valid"]:
+        record["annotation_texts"] = annotations
+    return record
+
+
+def run(paths, output, workers=4, measure=False):
+    """Analyses every query of the given files and directories in parallel and writes one JSON line per query
+    as soon as it finishes.
+
+    Args:
+        paths (list): Files and directories of SQL
+        output (file): Stream the JSON Lines are written to
+        workers (int, optional): Number of queries analysed at the same time, at most the [pool] size. Defaults to 4.
+        measure (bool, optional): Also runs EXPLAIN ANALYZE on the QEP and the cheapest AQPs. Defaults to False.
+
+    Returns:
+        int: Number of invalid or failed queries
+    """
+    db = Database()
+    db.measure = db.measure or measure
+    failed = 0
+    if workers > db.pool.size:
+        # every analysis holds a pooled connection, further workers would only wait for one until the pool timeout
+        print(f"analysing {db.pool.size} queries at a time, the [pool] size", file=sys.stderr)
+        workers = db.pool.size
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(analyse, db, query_id, query) for query_id, query in load_queries(paths)]
+            for future in as_completed(futures):
+                record = future.result()
+                failed += not record["valid"]
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+    finally:
+        db.closeConnection()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse SQL queries and write the QEP, AQP and annotation results as JSON Lines.")
+    parser.add_argument("paths", nargs="+", help="SQL files, or directories of .sql files")
+    parser.add_argument("-o", "--output", help="output file, standard output by default")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="queries analysed at the same time (default: 4)")
+    parser.add_argument("--analyze", action="store_true", help="execute the QEP and the cheapest AQPs with EXPLAIN ANALYZE, SELECT queries only")
+    args = parser.parse_args(argv)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            failed = run(args.paths, output, args.workers, args.analyze)
+    else:
+        failed = run(args.paths, sys.stdout, args.workers, args.analyze)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
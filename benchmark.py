@@ -0,0 +1,313 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from batch import load_queries
+from dbpool import ConnectionPool
+from graphstore import GraphStore
+from interface import QueryPlan
+from plancache import PlanCache
+from preprocessing import Database
+from replay import ExplainRecording
+
+# Run in a fresh interpreter: times importing the web application, creating it and answering its first request.
+# argv: query, recording to replay ("" for the live database), directory of this file
+STARTUP_PROBE = """
+import json, sys, tempfile, time
+sys.path.insert(0, sys.argv[3])
+start = time.perf_counter()
+import interface
+imported = time.perf_counter()
+app = interface.FlaskApp()
+created = time.perf_counter()
+if sys.argv[2]:
+    from dbpool import ConnectionPool
+    from replay import ExplainRecording
+    factory = ExplainRecording(sys.argv[2]).replayConnection
+    app.db.pool = ConnectionPool(factory, app.db.pool.size, name="analyzer")
+    app.db.workerPool = ConnectionPool(factory, app.db.workers, name="aqp")
+with tempfile.TemporaryDirectory() as path:
+    app.graphs = interface.GraphStore(path)
+    requested = time.perf_counter()
+    status = app.app.test_client().post("/queryplan", data={"queryText": sys.argv[1]}).status_code
+    answered = time.perf_counter()
+print(json.dumps({"import": imported - start, "create": created - imported, "first_request": answered - requested,
+                  "status": status}))
+"""
+
+STAGES = ["checkValidQuery", "query", "AQPwrapper", "processPlans", "generateQueryPlan", "QueryPlan", "save_graph_file"]
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of the values, interpolating between the closest ranks.
+
+    Args:
+        values (list): Measurements
+        p (float): Percentile between 0 and 100
+
+    Returns:
+        float: Percentile, None if there are no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def timed(method, stage, timings):
+    """Wraps a method of an analyzer so that the time of its outermost calls is added to a stage.
+    Recursive calls, e.g. of processPlans, are counted once.
+
+    Args:
+        method (callable): Bound method
+        stage (str): Stage name
+        timings (dict): Stage name to seconds spent in the current run
+
+    Returns:
+        callable: Timed method
+    """
+    depth = 0
+
+    def wrapper(*args, **kwargs):
+        nonlocal depth
+        depth += 1
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            depth -= 1
+            if depth == 0:
+                timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+    return wrapper
+
+
+def run_pipeline(db, query, store, graph_format):
+    """Runs the analysis of the web application on one query and times every stage.
+
+    Args:
+        db (Database): Database with the connection pools to use
+        query (str): SQL query
+        store (GraphStore): Store the QEP graph is rendered into
+        graph_format (str): "svg" or "png"
+
+    Returns:
+        dict: Stage name to seconds, None if the query is invalid
+    """
+    timings = {}
+    with db.analyzer() as analyzer:
+        analyzer.processPlans = timed(analyzer.processPlans, "processPlans", timings)
+        analyzer.AQPwrapper = timed(analyzer.AQPwrapper, "AQPwrapper", timings)
+        start = time.perf_counter()
+        valid = analyzer.checkValidQuery(query)
+        timings["checkValidQuery"] = time.perf_counter() - start
+        if not valid:
+            return None
+        start = time.perf_counter()
+        qep = analyzer.query(query)
+        timings["query"] = time.perf_counter() - start
+        start = time.perf_counter()
+        analyzer.generateQueryPlan(qep["Plan"])
+        timings["generateQueryPlan"] = time.perf_counter() - start
+    start = time.perf_counter()
+    graph = QueryPlan(qep["Plan"])
+    timings["QueryPlan"] = time.perf_counter() - start
+    start = time.perf_counter()
+    name = graph.save_graph_file(graph_format, store)
+    timings["save_graph_file"] = time.perf_counter() - start
+    os.remove(os.path.join(store.path, name))
+    return timings
+
+
+def benchmark(queries, db, recording, iterations=5, graph_format="svg"):
+    """Runs every query a number of times with a cold plan cache, then once more to measure peak memory.
+
+    Args:
+        queries (list): (id, query) pairs
+        db (Database): Database with the connection pools to use
+        recording (ExplainRecording): Recording counting the EXPLAIN statements
+        iterations (int, optional): Timed runs per query. Defaults to 5.
+        graph_format (str, optional): "svg" or "png". Defaults to "svg".
+
+    Returns:
+        dict: Results with per stage percentiles in milliseconds, EXPLAIN counts and peak memory per query
+    """
+    samples = {stage: [] for stage in STAGES + ["total"]}
+    results = {"queries": {}}
+    with tempfile.TemporaryDirectory() as path:
+        store = GraphStore(path)
+        for query_id, query in queries:
+            record = {"explains": 0, "stages": {}}
+            results["queries"][query_id] = record
+            try:
+                for _ in range(iterations):
+                    db.cache = PlanCache()
+                    explains = recording.explains
+                    start = time.perf_counter()
+                    timings = run_pipeline(db, query, store, graph_format)
+                    total = time.perf_counter() - start
+                    if timings is None:
+                        record["error"] = "invalid query"
+                        break
+                    timings["total"] = total
+                    record["explains"] = recording.explains - explains
+                    for stage, seconds in timings.items():
+                        samples[stage].append(seconds * 1000)
+                        record["stages"].setdefault(stage, []).append(seconds * 1000)
+                else:
+                    db.cache = PlanCache()
+                    tracemalloc.start()
+                    try:
+                        run_pipeline(db, query, store, graph_format)
+                        record["peak_memory"] = tracemalloc.get_traced_memory()[1]
+                    finally:
+                        tracemalloc.stop()
+            except Exception as e:
+                record["error"] = f"{type(e).__name__}: {e}"
+            record["stages"] = {stage: round(percentile(ms, 50), 3) for stage, ms in record["stages"].items()}
+
+    results["stages"] = {stage: {f"p{p}": round(percentile(ms, p), 3) for p in (50, 90, 99)} | {"n": len(ms)}
+                         for stage, ms in samples.items() if ms}
+    measured = [r for r in results["queries"].values() if "error" not in r]
+    results["explains"] = sum(r["explains"] for r in measured)
+    results["peak_memory"] = max((r["peak_memory"] for r in measured), default=0)
+    return results
+
+
+def startup(query, replay=None, runs=3):
+    """Starts the web application in fresh interpreters and times its import, its creation and its first request,
+    which analyses the query. The plan cache of a fresh process is empty, so the first request also opens the
+    connections and explains every plan.
+
+    Args:
+        query (str): SQL query of the first request
+        replay (str, optional): Recording answering the EXPLAIN statements. Defaults to the live database.
+        runs (int, optional): Number of processes started. Defaults to 3.
+
+    Returns:
+        dict: Median milliseconds of "import", "create" and "first_request", with "n" the number of runs
+    """
+    samples = {"import": [], "create": [], "first_request": []}
+    for _ in range(runs):
+        probe = subprocess.run([sys.executable, "-c", STARTUP_PROBE, query, replay or "",
+                                os.path.dirname(os.path.abspath(__file__))],
+                               capture_output=True, text=True, check=True)
+        # the last line is the result, the analysis may print before it
+        measured = json.loads(probe.stdout.strip().splitlines()[-1])
+        if measured["status"] != 200:
+            raise RuntimeError(f"first request answered with status {measured['status']}")
+        for name in samples:
+            samples[name].append(measured[name] * 1000)
+    return {name: round(percentile(ms, 50), 3) for name, ms in samples.items()} | {"n": runs}
+
+
+def compare(results, baseline, tolerance):
+    """Compares the median stage latencies with a saved baseline.
+
+    Args:
+        results (dict): Results of benchmark
+        baseline (dict): Results saved by an earlier run
+        tolerance (float): Slowdown factor above which a stage counts as a regression
+
+    Returns:
+        list: Lines describing every stage, regressions marked
+    """
+    lines, regressions = [], 0
+    for stage, stats in results["stages"].items():
+        before = baseline["stages"].get(stage, {}).get("p50")
+        if not before:
+            continue
+        ratio = stats["p50"] / before
+        regressed = ratio > tolerance
+        regressions += regressed
+        lines.append(f"{stage:<18} {before:>10.3f} -> {stats['p50']:>10.3f} ms  x{ratio:.2f}{'  REGRESSION' if regressed else ''}")
+    for name, ms in results.get("startup", {}).items():
+        before = baseline.get("startup", {}).get(name)
+        if name == "n" or not before:
+            continue
+        ratio = ms / before
+        regressed = ratio > tolerance
+        regressions += regressed
+        lines.append(f"startup {name:<10} {before:>10.3f} -> {ms:>10.3f} ms  x{ratio:.2f}{'  REGRESSION' if regressed else ''}")
+    if baseline.get("explains") and results["explains"] > baseline["explains"]:
+        regressions += 1
+        lines.append(f"EXPLAIN statements {baseline['explains']} -> {results['explains']}  REGRESSION")
+    return lines, regressions
+
+
+def report(results, output):
+    """Prints the stage percentiles, EXPLAIN count and peak memory.
+
+    Args:
+        results (dict): Results of benchmark
+        output (file): Stream to print to
+    """
+    print(f"{'stage':<18} {'n':>5} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10}", file=output)
+    for stage, stats in results["stages"].items():
+        print(f"{stage:<18} {stats['n']:>5} {stats['p50']:>10.3f} {stats['p90']:>10.3f} {stats['p99']:>10.3f}", file=output)
+    print(f"EXPLAIN statements per run: {results['explains']}", file=output)
+    print(f"peak memory of one analysis: {results['peak_memory'] / 1024 / 1024:.1f} MiB", file=output)
+    if "startup" in results:
+        measured = results["startup"]
+        print(f"startup (median of {measured['n']} processes): import {measured['import']:.1f} ms, "
+              f"FlaskApp {measured['create']:.1f} ms, first request {measured['first_request']:.1f} ms", file=output)
+    for query_id, record in results["queries"].items():
+        if "error" in record:
+            print(f"{query_id}: {record['error']}", file=output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the query analysis pipeline.")
+    parser.add_argument("paths", nargs="*", default=["queries/tpch"], help="SQL files, or directories of .sql files (default: queries/tpch)")
+    parser.add_argument("-n", "--iterations", type=int, default=5, help="timed runs per query (default: 5)")
+    parser.add_argument("--format", default="svg", choices=["svg", "png"], help="graph format (default: svg)")
+    parser.add_argument("--replay", help="answer EXPLAIN statements from a recording instead of the database")
+    parser.add_argument("--record", help="save the EXPLAIN statements of this run to a recording")
+    parser.add_argument("--save", help="save the results as a baseline")
+    parser.add_argument("--baseline", help="compare with a saved baseline, exit status 1 on regressions")
+    parser.add_argument("--startup", type=int, default=3, help="fresh processes timing the start of the web application, 0 skips (default: 3)")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="slowdown factor counted as a regression (default: 1.25)")
+    args = parser.parse_args(argv)
+
+    db = Database()
+    # the plan cache is replaced before every run so that every run explains its plans
+    if args.replay:
+        recording = ExplainRecording(args.replay)
+        factory = recording.replayConnection
+    else:
+        recording = ExplainRecording()
+        factory = lambda: recording.recordingConnection(db.newConnection())
+    db.pool = ConnectionPool(factory, db.pool.size, name="analyzer")
+    db.workerPool = ConnectionPool(factory, db.workers, name="aqp")
+    queries = load_queries(args.paths)
+    try:
+        results = benchmark(queries, db, recording, args.iterations, args.format)
+    finally:
+        db.closeConnection()
+    if args.startup and queries:
+        results["startup"] = startup(queries[0][1], args.replay, args.startup)
+    results["config"] = {"backend": "replay" if args.replay else "live", "iterations": args.iterations,
+                         "format": args.format, "search": db.search, "probe": db.probe, "workers": db.workers}
+    report(results, sys.stdout)
+    if args.record:
+        recording.save(args.record)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            lines, regressions = compare(results, json.load(f), args.tolerance)
+        print("\n".join(lines))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+import queue
+import random
+import threading
+import time
+
+from metrics import registry
+
+registry.gauge("aqp_pool_size", "Maximum number of connections of each pool")
+registry.gauge("aqp_pool_connections", "Connections currently open in each pool")
+registry.histogram("aqp_pool_wait_seconds", "Time spent checking out a connection, including opening, checking and "
+                   "resetting it", buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+registry.counter("aqp_pool_opened_total", "Connections opened by each pool")
+registry.counter("aqp_pool_discarded_total", "Connections closed by each pool because they failed a check or reset")
+registry.counter("aqp_pool_resets_total", "Session resets run on checked out connections")
+registry.counter("aqp_pool_timeouts_total", "Checkouts that gave up waiting for a free connection")
+
+
+class ConnectionPool:
+    """
+    Fixed size pool of database connections shared between worker threads. Idle connections are checked before
+    they are handed out again and sessions changed by their last user are reset, so that a dropped connection
+    or a leftover setting only affects the request that caused it.
+    """
+    def __init__(self, factory, size, retries=0, backoff=0.5, transient=(Exception,), name="default",
+                 timeout=None, check=None, reset=None):
+        """
+        Creates an empty pool. Connections are only opened when first needed.
+        :param factory: callable returning a new connection
+        :param size: maximum number of connections held by the pool
+        :param retries: number of times opening a connection is retried after a transient error
+        :param backoff: seconds waited before the first retry, doubled for every further retry
+        :param transient: exception types worth retrying, e.g. the server not accepting connections yet
+        :param name: pool label of the metrics
+        :param timeout: seconds getconn waits for a connection to be returned, None waits forever
+        :param check: callable(conn, idleSeconds) returning False if an idle connection must not be used anymore
+        :param reset: callable(conn) restoring the session of a connection returned as dirty
+        """
+        self.factory = factory
+        self.size = max(1, size)
+        self.retries = retries
+        self.backoff = backoff
+        self.transient = transient
+        self.name = name
+        self.timeout = timeout
+        self.check = check
+        self.reset = reset
+        # (connection, time it was returned, dirty), or None to wake a waiting getconn after a connection was closed
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        registry.set("aqp_pool_size", self.size, pool=name)
+
+    def connect(self):
+        """
+        Opens a new connection, retrying transient errors with exponential backoff and jitter
+        :return: connection
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                conn = self.factory()
+                registry.increment("aqp_pool_opened_total", pool=self.name)
+                return conn
+            except self.transient:
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.0))
+
+    def reserve(self):
+        """
+        Takes a free slot for a new connection
+        :return: True if the pool was below its size
+        """
+        with self.lock:
+            if self.opened >= self.size:
+                return False
+            self.opened += 1
+            registry.set("aqp_pool_connections", self.opened, pool=self.name)
+        return True
+
+    def release(self):
+        """
+        Frees the slot of a connection that was closed or could not be opened, waking a waiting getconn to use it
+        :return: None
+        """
+        with self.lock:
+            self.opened -= 1
+            registry.set("aqp_pool_connections", self.opened, pool=self.name)
+        self.idle.put(None)
+
+    def getconn(self):
+        """
+        Checks out a connection: an idle one that passes the check, reset if its last user changed its session,
+        or a new one while below the pool size. Blocks until a connection is returned otherwise, at most the
+        pool timeout.
+        :return: connection
+        """
+        start = time.monotonic()
+        while True:
+            try:
+                entry = self.idle.get_nowait()
+            except queue.Empty:
+                if self.reserve():
+                    try:
+                        conn = self.connect()
+                    except Exception:
+                        self.release()
+                        raise
+                    break
+                entry = self.wait(start)
+            if entry is None:
+                continue
+            conn = self.prepare(*entry)
+            if conn is not None:
+                break
+        registry.observe("aqp_pool_wait_seconds", time.monotonic() - start, pool=self.name)
+        return conn
+
+    def wait(self, start):
+        """
+        Waits for a connection to be returned
+        :param start: monotonic time the checkout started
+        :return: idle entry
+        """
+        try:
+            if self.timeout is None:
+                return self.idle.get()
+            return self.idle.get(timeout=max(0.0, start + self.timeout - time.monotonic()))
+        except queue.Empty:
+            registry.increment("aqp_pool_timeouts_total", pool=self.name)
+            raise TimeoutError(f"no connection of pool '{self.name}' was returned within {self.timeout} s") from None
+
+    def prepare(self, conn, returned, dirty):
+        """
+        Checks an idle connection and resets its session if needed. Connections failing either are closed.
+        :param conn: idle connection
+        :param returned: monotonic time the connection was returned
+        :param dirty: whether the last user changed the session
+        :return: connection, None if it was closed
+        """
+        try:
+            usable = self.check is None or self.check(conn, time.monotonic() - returned)
+            if usable and dirty and self.reset is not None:
+                self.reset(conn)
+                registry.increment("aqp_pool_resets_total", pool=self.name)
+        except Exception:
+            usable = False
+        if usable:
+            return conn
+        registry.increment("aqp_pool_discarded_total", pool=self.name)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self.release()
+        return None
+
+    def putconn(self, conn, dirty=False):
+        """
+        Returns a connection to the pool
+        :param conn: connection previously checked out with getconn
+        :param dirty: whether the session was changed, e.g. by SET statements, so that it is reset before reuse
+        :return: None
+        """
+        self.idle.put((conn, time.monotonic(), dirty))
+
+    def prewarm(self, count):
+        """
+        Opens up to count connections in a background thread, so that the first requests find them idle.
+        Failures are ignored, the connections are then opened by getconn when needed.
+        :param count: number of connections to open
+        :return: thread opening the connections
+        """
+        def openConnections():
+            for _ in range(count):
+                if not self.reserve():
+                    return
+                try:
+                    conn = self.connect()
+                except Exception:
+                    self.release()
+                    return
+                self.putconn(conn)
+
+        thread = threading.Thread(target=openConnections, name="pool-prewarm", daemon=True)
+        thread.start()
+        return thread
+
+    def closeall(self):
+        """
+        Closes every idle connection in the pool
+        :return: None
+        """
+        while True:
+            try:
+                entry = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                continue
+            entry[0].close()
+            with self.lock:
+                self.opened -= 1
+                registry.set("aqp_pool_connections", self.opened, pool=self.name)
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import struct
+
+DIGEST_SIZE = 16
+
+# fields that shape what a plan node does, besides the node type, relation, join condition, costs and rows held in
+# the PlanTree arrays. Derived or cosmetic fields such as "Plan Width", "Alias" or "Async Capable" are left out.
+STRUCTURAL = frozenset((
+    "Parallel Aware", "Parent Relationship", "Subplan Name", "Join Type", "Strategy", "Partial Mode", "Index Name",
+    "Scan Direction", "Index Cond", "Recheck Cond", "Filter", "Join Filter", "Hash Cond", "Merge Cond", "Sort Key",
+    "Presorted Key", "Group Key", "Cache Key", "Cache Mode", "Workers Planned", "Single Copy", "Planned Partitions",
+    "CTE Name", "Function Name", "Command", "Operation"))
+# startup cost, total cost and rows of a node
+NUMBERS = struct.Struct("<ddq")
+# encoded text fields of a node -> bytes. The same nodes recur in the plans of every combination, so encoding
+# them once halves the time to fingerprint a plan. Cleared once it holds ENCODED_LIMIT nodes.
+ENCODED = {}
+ENCODED_LIMIT = 65536
+
+
+def planFingerprint(value):
+    """
+    Hashes a JSON serializable value, e.g. the labels and edges of a rendered graph. Keys are sorted, so two values
+    share a fingerprint exactly when they are equal.
+    :param value: value to hash
+    :return: 16 byte fingerprint
+    """
+    return hashlib.blake2b(json.dumps(value, sort_keys=True).encode(), digest_size=DIGEST_SIZE).digest()
+
+
+def treeFingerprints(tree):
+    """
+    Hashes every subtree of a PlanTree from its structural fields: node type, relation, join condition, costs, rows
+    and the STRUCTURAL details, in the order EXPLAIN lists them. Nodes are hashed from the last to the first, so the
+    fingerprint of a node covers its own fields and the fingerprints of its children, which were hashed before.
+    :param tree: PlanTree
+    :return: bytes holding the fingerprint of the subtree of node i at i * DIGEST_SIZE
+    """
+    count = len(tree.types)
+    digests = [None] * count
+    types, relations, conditions, details = tree.types, tree.relations, tree.conditions, tree.details
+    startupCosts, totalCosts, planRows, ends = tree.startupCosts, tree.totalCosts, tree.planRows, tree.ends
+    for i in range(count - 1, -1, -1):
+        fields = details[i]
+        text = (types[i], relations[i], conditions[i],
+                tuple([item for item in fields.items() if item[0] in STRUCTURAL]) if fields else ())
+        encoded = ENCODED.get(text)
+        if encoded is None:
+            if len(ENCODED) >= ENCODED_LIMIT:
+                ENCODED.clear()
+            encoded = ENCODED[text] = repr(text).encode()
+        digest = hashlib.blake2b(encoded, digest_size=DIGEST_SIZE)
+        digest.update(NUMBERS.pack(startupCosts[i], totalCosts[i], planRows[i]))
+        child, end = i + 1, ends[i]
+        while child < end:
+            digest.update(digests[child])
+            child = ends[child]
+        digests[i] = digest.digest()
+    return b"".join(digests)
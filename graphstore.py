@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+import uuid
+
+
+class GraphStore:
+    """
+    Directory of rendered plan graphs named by a hash of the plan structure, so identical plans share one file.
+    The directory is bounded by total size and file age, evicting the least recently used graphs first. Graphs used
+    within the last minAge seconds are never evicted, so the page of a concurrent request can still load them.
+    """
+    def __init__(self, path="graphs", maxBytes=64 * 1024 * 1024, maxAge=86400, minAge=60):
+        """
+        Creates the store
+        :param path: directory the graphs are written to
+        :param maxBytes: maximum total size of the stored graphs, exceeded while recently used graphs need more
+        :param maxAge: seconds a graph is kept after it was last used
+        :param minAge: seconds a graph is kept after it was last used in any case
+        """
+        self.path = os.path.abspath(path)
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.minAge = minAge
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def fileName(self, key, fileFormat):
+        """
+        Name of the graph file of a plan
+        :param key: hex digest of the plan structure
+        :param fileFormat: "svg" or "png"
+        :return: file name inside the store directory
+        """
+        return f"qep_{key}.{fileFormat}"
+
+    def fetch(self, key, fileFormat, render):
+        """
+        Returns the graph of a plan, rendering it only if it is not stored yet
+        :param key: hex digest of the plan structure
+        :param fileFormat: "svg" or "png"
+        :param render: function writing the graph to the file path it is given
+        :return: file name inside the store directory
+        """
+        name = self.fileName(key, fileFormat)
+        path = os.path.join(self.path, name)
+        try:
+            # refresh the modification time, which orders eviction
+            os.utime(path)
+            return name
+        except FileNotFoundError:
+            pass
+        # render to a private file first, so concurrent requests never serve a partial graph
+        temp = os.path.join(self.path, f".{uuid.uuid4().hex}.{fileFormat}")
+        try:
+            render(temp)
+            os.replace(temp, path)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        self.evict(keep=name)
+        return name
+
+    def evict(self, keep=None):
+        """
+        Deletes graphs unused for longer than maxAge, then the least recently used ones until the store fits in maxBytes.
+        Graphs used within the last minAge seconds are kept, they may have been rendered for a page not loaded yet.
+        :param keep: file name that must not be deleted
+        :return: None
+        """
+        with self.lock:
+            now = time.time()
+            files = []
+            for entry in os.scandir(self.path):
+                if not entry.name.startswith("qep_") or entry.name == keep:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            if keep is not None:
+                try:
+                    total += os.path.getsize(os.path.join(self.path, keep))
+                except FileNotFoundError:
+                    pass
+            for mtime, size, path in sorted(files):
+                # the files are ordered by last use, every following one was used more recently
+                if now - mtime < self.minAge or (now - mtime <= self.maxAge and total <= self.maxBytes):
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
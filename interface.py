@@ -1,23 +1,44 @@
-from flask import Flask, render_template, redirect, request, flash
-from preprocessing import Database
-import networkx as nx
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import random
+from preprocessing import Database, INVALID_QUERY, stage
+from graphstore import GraphStore
+from fingerprint import planFingerprint
+from plantree import PlanTree
+from metrics import registry
+import html
 import os
 import time
+import threading
+import uuid
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from annotation import *
-import sqlparse
 import math
 import traceback
+import io
+import hmac
 
 ##################################### Flask App #####################################
 class FlaskApp:
     def __init__(self):
+        # Flask is only imported by the web application, benchmark.py uses the rest of this module without it
+        from flask import Flask, render_template, redirect, request, flash, jsonify, url_for, Response, send_from_directory
         self.app = Flask(__name__)
         self.app.secret_key = b'secret key for 4031'
         self.db = Database()
+        # connections are opened in the background, the application starts even while the database is unreachable
+        self.db.pool.prewarm(self.db.config.getint('pool', 'prewarm', fallback=1))
+        # "svg" renders graphs without matplotlib, "png" draws them with matplotlib
+        self.graph_format = self.db.config.get('render', 'format', fallback='svg')
+        self.graphs = GraphStore(self.db.config.get('graphs', 'path', fallback='graphs'),
+                                 self.db.config.getint('graphs', 'max_bytes', fallback=64 * 1024 * 1024),
+                                 self.db.config.getint('graphs', 'max_age', fallback=86400),
+                                 self.db.config.getint('graphs', 'min_age', fallback=60))
+        self.jobs = JobManager(self.db, self.graphs, self.db.config.getint('jobs', 'workers', fallback=4), self.graph_format)
+        # queries of one JSON API request, and how many of them are analysed at the same time
+        self.api_max_queries = self.db.config.getint('api', 'max_queries', fallback=100)
+        self.api_workers = self.db.config.getint('api', 'workers', fallback=2)
+        # requests carrying this token in the X-Profile header are run under cProfile, empty disables profiling
+        self.profile_token = self.db.config.get('metrics', 'profile_token', fallback='')
 
         @self.app.route('/', methods=["GET"])
         def requestQuery():
@@ -28,58 +49,353 @@ class FlaskApp:
         @self.app.route("/queryplan", methods=["POST", "GET"])
         def queryPlan():
             if request.method == "POST":
-                self.db.resetState()
                 query = request.form["queryText"]
-                if self.db.checkValidQuery(query):
-                    try:
-                        qep = self.db.query(query)
-                        self.db.generateQueryPlan(qep["Plan"])
-
-                        # Generate graph for qep and aqp
-                        qepgraph = QueryPlan(qep["Plan"])
-                        graphfile = qepgraph.save_graph_file()
-
-                        aqpgraphfiles = []
-                        prev_val = 0
-                        all_aqp = [ aqp['Plan'] for aqp in self.db.altQueryPlans]
-                        sorted_aqp = sorted(all_aqp, key = lambda x:x['Total Cost'])
-                        for _ in range(3):
-                            while len(sorted_aqp) > 1 and sorted_aqp[-1]["Total Cost"] == prev_val:
-                                sorted_aqp.pop()
-                            if sorted_aqp and sorted_aqp[-1]["Total Cost"] != qep["Plan"]["Total Cost"]:
-                                prev_val = sorted_aqp[-1]["Total Cost"]
-                                temp = QueryPlan(sorted_aqp.pop())
-                                aqpgraphfiles.append(temp.save_graph_file())
-
-
-                        render_args = {
-                            "query": sqlparse.format(query, reindent=True, keyword_case='upper'),
-                            "annotations": self.db.queryPlanList,
-                            "total_cost": qep["Plan"]["Total Cost"],
-                            "total_operations": qepgraph.get_num_nodes(),
-                            "qep_graph": graphfile,
-                            "aqp_graph": aqpgraphfiles
-                        }
-                        # restore to default
-                        self.db.queryPlanList = []
-                        self.db.altQueryPlans = []
-                        self.db.scanDict = {}
-                        self.db.joinDict = {}
-                        return render_template("queryplan.html", **render_args)
-                    except Exception as e:
-                        print(traceback.format_exc())
-                        return redirect('/')
-                else: 
-                    flash('Invalid SQL Query or Query Timeout!', 'error')
+                try:
+                    # every request analyses on its own state and pooled connection
+                    with self.db.analyzer() as analyzer:
+                        render_args = analyse_query(analyzer, query, self.graphs, self.graph_format, self.profile_requested())
+                except Exception as e:
+                    print(traceback.format_exc())
                     return redirect('/')
+                if render_args is None:
+                    flash(INVALID_QUERY, 'error')
+                    return redirect('/')
+                return render_template("queryplan.html", **render_args)
             return redirect('/')
+
+        @self.app.route("/jobs", methods=["POST"])
+        def submitJob():
+            body = request.get_json(silent=True)
+            query = request.form.get("queryText") or (body.get("queryText") if isinstance(body, dict) else None)
+            if not isinstance(query, str) or not query.strip():
+                return jsonify({"error": "queryText is required"}), 400
+            job = self.jobs.submit(query, self.profile_requested())
+            return jsonify({
+                "id": job.id,
+                "status": url_for("jobStatus", job_id=job.id),
+                "events": url_for("jobEvents", job_id=job.id),
+                "result": url_for("jobResult", job_id=job.id)
+            }), 202
+
+        @self.app.route("/jobs/<job_id>", methods=["GET"])
+        def jobStatus(job_id):
+            job = self.jobs.get(job_id)
+            if job is None:
+                return jsonify({"error": "unknown job"}), 404
+            return jsonify(job.status())
+
+        @self.app.route("/jobs/<job_id>/events", methods=["GET"])
+        def jobEvents(job_id):
+            job = self.jobs.get(job_id)
+            if job is None:
+                return jsonify({"error": "unknown job"}), 404
+
+            def stream():
+                # server-sent events: one progress message per poll until the job finishes
+                while True:
+                    status = job.status()
+                    yield f"data: {json.dumps(status)}\n\n"
+                    if status["state"] in ("done", "failed"):
+                        return
+                    job.finished.wait(0.5)
+
+            return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+        @self.app.route("/jobs/<job_id>/result", methods=["GET"])
+        def jobResult(job_id):
+            job = self.jobs.get(job_id)
+            if job is None:
+                return redirect('/')
+            if job.state == "failed":
+                flash(job.error, 'error')
+                return redirect('/')
+            if job.state != "done":
+                return jsonify(job.status()), 202
+            return render_template("queryplan.html", **job.result)
+
+        @self.app.route("/graphs/<name>", methods=["GET"])
+        def graphFile(name):
+            # graph files are named by the plan they show, so their content never changes
+            response = send_from_directory(self.graphs.path, name, max_age=self.graphs.maxAge)
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+            return response
+
+        @self.app.route("/api/analyses", methods=["POST"])
+        def analyses():
+            # {"query": "..."} or {"queries": ["...", ...]}, answered with {"results": [...]} in the same order
+            body = request.get_json(silent=True)
+            queries = None
+            if isinstance(body, dict):
+                queries = body.get("queries", [body["query"]] if "query" in body else None)
+            if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q.strip() for q in queries):
+                return jsonify({"error": "query or queries (a list of SQL strings) is required"}), 400
+            if len(queries) > self.api_max_queries:
+                return jsonify({"error": f"at most {self.api_max_queries} queries per request"}), 413
+            results = self.db.analyseMany(queries, self.api_workers,
+                                          lambda analyzer, outcome: record_metrics(analyzer, analyzer.timings, outcome))
+            return jsonify({"results": results})
+
+        @self.app.route("/metrics", methods=["GET"])
+        def metrics():
+            return Response(registry.render(), mimetype="text/plain; version=0.0.4")
            
+    def profile_requested(self) -> bool:
+        """Checks whether the current request asks to be profiled with the configured token.
+
+        Returns:
+            bool: True if the analysis should run under cProfile
+        """
+        from flask import request
+        token = request.headers.get("X-Profile", "")
+        return bool(self.profile_token) and hmac.compare_digest(token, self.profile_token)
+
     def run(self):
-        self.app.run()
+        self.app.run(threaded=True)
+
+
+def analyse_query(analyzer, query, graph_store, graph_format="svg", profile=False):
+    """Validates the query, enumerates its AQPs and renders the QEP and up to three AQPs.
+    The time of every stage and the database counters of the analyzer are added to the metrics registry.
+
+    Args:
+        analyzer (QueryAnalyzer): Analyzer of the current request
+        query (str): SQL query
+        graph_store (GraphStore): Store the graphs are rendered into
+        graph_format (str, optional): "svg" or "png". Defaults to "svg".
+        profile (bool, optional): Runs the analysis under cProfile. Defaults to False.
+
+    Returns:
+        dict: Arguments for queryplan.html, None if the query is invalid
+    """
+    timings = {}
+    profiler = None
+    if profile:
+        # the profiler modules are only needed by profiled requests
+        import cProfile
+        profiler = cProfile.Profile()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with stage(timings, "total"):
+            render_args = run_stages(analyzer, query, graph_store, graph_format, timings)
+    except Exception:
+        record_metrics(analyzer, timings, "error")
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+    record_metrics(analyzer, timings, "ok" if render_args is not None else "invalid")
+    if render_args is None:
+        return None
+
+    counters = analyzer.counters
+    render_args["metrics"] = {
+        "stages": {name: round(seconds * 1000, 3) for name, seconds in timings.items()},
+        "explains": counters["explains"],
+        "distinct": analyzer.aqpStats.get("distinct", 0),
+        "round_trips": counters["roundTrips"],
+        "round_trip_ms": round(counters["roundTripTime"] * 1000, 3),
+        "planner_ms": round(counters["plannerTime"] * 1000, 3)
+    }
+    if profiler is not None:
+        import pstats
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(40)
+        render_args["profile"] = text.getvalue()
+    return render_args
+
+
+def run_stages(analyzer, query, graph_store, graph_format, timings):
+    """Runs the stages of an analysis shared with the JSON API (QueryAnalyzer.runStages), then renders the results.
+
+    Args:
+        analyzer (QueryAnalyzer): Analyzer of the current request
+        query (str): SQL query
+        graph_store (GraphStore): Store the graphs are rendered into
+        graph_format (str): "svg" or "png"
+        timings (dict): Receives the seconds spent in every stage
+
+    Returns:
+        dict: Arguments for queryplan.html, None if the query is invalid
+    """
+    qep = analyzer.runStages(query, timings)
+    if qep is None:
+        return None
+
+    with stage(timings, "render"):
+        measured = None
+        if analyzer.db.measure:
+            if analyzer.measurementError is None:
+                measured = analyzer.db.annotation.compareMeasuredAnno(analyzer.measurements)
+            else:
+                measured = [("Not measured", analyzer.measurementError)]
+
+        # Generate graph for qep and aqp
+        qepgraph = QueryPlan(qep["Plan"])
+        graphfile = qepgraph.save_graph_file(graph_format, graph_store)
+
+        # the AQPs were selected and ranked during the enumeration, see [aqp] display and rank
+        aqpgraphfiles = [QueryPlan(aqp["Plan"]).save_graph_file(graph_format, graph_store)
+                         for aqp in analyzer.altQueryPlans]
+
+    import sqlparse
+    return {
+        "query": sqlparse.format(query, reindent=True, keyword_case='upper'),
+        "annotations": analyzer.queryPlanList,
+        "total_cost": qep["Plan"]["Total Cost"],
+        "total_operations": qepgraph.get_num_nodes(),
+        "qep_graph": graphfile,
+        "aqp_graph": aqpgraphfiles,
+        "measured": measured
+    }
+
+
+def record_metrics(analyzer, timings, outcome):
+    """Adds the stage timings and database counters of an analysis to the metrics registry.
+
+    Args:
+        analyzer (QueryAnalyzer): Analyzer of the request
+        timings (dict): Stage name to seconds
+        outcome (str): "ok", "invalid" or "error"
+    """
+    registry.increment("aqp_requests_total", outcome=outcome)
+    for name, seconds in timings.items():
+        registry.observe("aqp_stage_seconds", seconds, stage=name)
+    counters = analyzer.counters
+    registry.increment("aqp_explains_total", counters["explains"])
+    registry.increment("aqp_distinct_plans_total", analyzer.aqpStats.get("distinct", 0))
+    registry.increment("aqp_db_round_trips_total", counters["roundTrips"])
+    registry.increment("aqp_db_round_trip_seconds_total", counters["roundTripTime"])
+    registry.increment("aqp_planner_seconds_total", counters["plannerTime"])
+
+##################################### Analysis Jobs #####################################
+
+class AnalysisJob:
+    def __init__(self, query, profile=False):
+        """Initialises a queued analysis of a query
+
+        Args:
+            query (str): SQL query to analyse
+            profile (bool, optional): Runs the analysis under cProfile. Defaults to False.
+        """
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.profile = profile
+        self.state = "queued"
+        self.analyzer = None
+        self.result = None
+        self.error = None
+        self.progress = {"explored": 0, "distinct": 0}
+        self.finished = threading.Event()
+
+    def status(self) -> dict:
+        """Returns the state and progress of the job.
+
+        Returns:
+            dict: State, plans explored and distinct plans found so far
+        """
+        analyzer = self.analyzer
+        progress = dict(analyzer.progress) if analyzer is not None else self.progress
+        return {"id": self.id, "state": self.state, "error": self.error, **progress}
+
+
+class JobManager:
+    def __init__(self, db, graph_store, workers=4, graph_format="svg", keep=100):
+        """Initialises the background executor running analysis jobs
+
+        Args:
+            db (Database): Shared database the analyzers borrow connections from
+            graph_store (GraphStore): Store the graphs are rendered into
+            workers (int, optional): Number of analyses running at the same time. Defaults to 4.
+            graph_format (str, optional): "svg" or "png". Defaults to "svg".
+            keep (int, optional): Number of finished jobs kept for polling. Defaults to 100.
+        """
+        self.db = db
+        self.graph_store = graph_store
+        self.graph_format = graph_format
+        self.keep = keep
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, query, profile=False) -> AnalysisJob:
+        """Queues the analysis of a query.
+
+        Args:
+            query (str): SQL query to analyse
+            profile (bool, optional): Runs the analysis under cProfile. Defaults to False.
+
+        Returns:
+            AnalysisJob: The queued job
+        """
+        job = AnalysisJob(query, profile)
+        with self.lock:
+            self.jobs[job.id] = job
+            # forget the oldest finished jobs
+            finished = [k for k, j in self.jobs.items() if j.finished.is_set()]
+            for k in finished[:max(0, len(self.jobs) - self.keep)]:
+                del self.jobs[k]
+        self.executor.submit(self.run, job)
+        return job
+
+    def get(self, job_id):
+        """Looks up a job.
+
+        Args:
+            job_id (str): Id returned on submission
+
+        Returns:
+            AnalysisJob: The job, None if unknown
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def run(self, job):
+        """Runs a job on the executor.
+
+        Args:
+            job (AnalysisJob): The job to run
+        """
+        job.state = "running"
+        try:
+            with self.db.analyzer() as analyzer:
+                job.analyzer = analyzer
+                job.result = analyse_query(analyzer, job.query, self.graph_store, self.graph_format, job.profile)
+                job.progress = dict(analyzer.progress)
+                job.analyzer = None
+            if job.result is None:
+                job.error = INVALID_QUERY
+                job.state = "failed"
+            else:
+                job.state = "done"
+        except Exception:
+            print(traceback.format_exc())
+            job.analyzer = None
+            job.error = "Analysis failed"
+            job.state = "failed"
+        finally:
+            job.finished.set()
 
 ##################################### Node & Graph #####################################
 
+# pyplot keeps global figure state, so concurrent requests render one graph at a time
+plot_lock = threading.Lock()
+
+def load_pyplot():
+    """Imports matplotlib on first use, so that it is only loaded when PNG export is requested.
+
+    Returns:
+        module: matplotlib.pyplot
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
 class Node:
+    __slots__ = ("node_type", "total_cost", "label")
+
     def __init__(self, node_type, cost, label=''):
         """Initialises a node with its type and total cost
 
@@ -103,213 +419,197 @@ class Node:
 class QueryPlan:
     def __init__(self, query):
         """Initialises the root node with the root query plan.
-        Constructs the graph and calculate attributes of the QEP:
-        1. Total cost
-        2. Plan rows
-        3. Number of sequential scan nodes
-        4. Number of index scan nodes
-        4. Explanation of the query plan
+        Constructs the tree and calculate attributes of the QEP:
+        1. Tree depth
+        2. Tree width
+        3. Position of every node in the hierarchical layout
 
         Args:
-            query (dict): Query plan that is generated by PostgreSQL
+            query (PlanNode): Root of the query plan generated by PostgreSQL, or the plan dict
         """
-        self.graph = nx.DiGraph()
-        self.root = self.create_node(query)
-        self.create_graph_node(self.root,query)
-        self.tree_depth = self.calculate_graph_depth(query)
-        self.tree_width = self.calculate_graph_width(query)
-    
+        self.nodes = []
+        self.edges = []
+        self.root, self.positions, self.tree_depth, self.tree_width = tree_layout(query, self.create_node, self.add_edge)
+
     def create_node(self,query):
         node_type = query['Node Type']
         if node_type in ["Bitmap Heap Scan", "Index Scan", "Index Only Scan","Seq Scan"]:
-            return Node(node_type,query["Total Cost"],"Table: "+query["Relation Name"])
+            node = Node(node_type,query["Total Cost"],"Table: "+query["Relation Name"])
         elif node_type == "Hash Join":
-            return Node(node_type,query["Total Cost"],query["Hash Cond"])
+            node = Node(node_type,query["Total Cost"],query["Hash Cond"])
         elif node_type == "Merge Join":
-            return Node(node_type,query["Total Cost"],query["Merge Cond"])
+            node = Node(node_type,query["Total Cost"],query["Merge Cond"])
         else:
-            return Node(query["Node Type"],query["Total Cost"])
-    
-    def calculate_graph_depth(self, query):
-        """Compute the depth of QEP plan.
+            node = Node(query["Node Type"],query["Total Cost"])
+        self.nodes.append(node)
+        return node
+
+    def add_edge(self, parent, child):
+        """Records the edge between a node and one of its child nodes.
 
         Args:
-            query (dict): The query plan.
+            parent (Node): The parent node.
+            child (Node): The child node.
         """
-        res = 0
+        self.edges.append((parent, child))
 
-        def helper(query):
-            nonlocal res
-            currdep = []
+    def fingerprint(self) -> str:
+        """Hashes everything the rendered graph shows: the node labels and the tree structure.
 
-            if "Plans" in query:
-                for child in query['Plans']:
-                    currdep.append(helper(child))
-                res = max(res,max(currdep))
-            else:
-                return 1
-            
-            return 1 + max(currdep)
-        
-        return helper(query)
-    
-    def calculate_graph_width(self,query):
-        """Compute the graph width.
+        Returns:
+            str: Hex digest of the graph
+        """
+        index = {node: i for i, node in enumerate(self.nodes)}
+        structure = [[str(node) for node in self.nodes], [[index[p], index[c]] for p, c in self.edges]]
+        return planFingerprint(structure).hex()
+
+    def save_graph_file(self, file_format="svg", store=None) -> str:
+        """Renders the graph and save the figure as an .svg (default) or .png file
+        in the 'static' folder, or in the graph store if one is given.
+        The frontend then renders the image on the UI to visualise the QEP.
 
         Args:
-            query (dict): Query plan.
+            file_format (str, optional): "svg" or "png". Only PNG export uses matplotlib and networkx. Defaults to "svg".
+            store (GraphStore, optional): Store reusing the file of an identical graph. Defaults to None.
+
+        Returns:
+            str: File name of graph
         """
-        if 'Plans' not in query:
-            return 0
-        q = []
-        maxWidth = 0
-    
-        q.append(query)
-    
-        while q:
-            # Get the size of queue when the level order traversal for one level finishes
-            count = len(q)
-    
-            # Update the maximum node count value
-            maxWidth = max(count, maxWidth)
-    
-            while count:
-                count = count-1
-                temp = q.pop(0)
-                if 'Plans' in temp:
-                    for child in temp['Plans']:
-                        q.append(child)
-    
-        return maxWidth
-
-
-    def create_graph_node(self, root,query):
-        """Constructs the graph recursively by forming an edge between each node
-        and each of its child nodes.
+        if store is not None:
+            return store.fetch(self.fingerprint(), file_format, lambda file_name: self.write_graph(file_name, file_format))
+        graph_name = f"qep_{str(time.time())}_{threading.get_ident()}.{file_format}"
+        self.write_graph(os.path.join(os.getcwd(), "static", graph_name), file_format)
+        return graph_name
+
+    def write_graph(self, file_name, file_format="svg"):
+        """Renders the graph into a file.
 
         Args:
-            root (Node): The parent node.
+            file_name (str): Path of the file
+            file_format (str, optional): "svg" or "png". Defaults to "svg".
         """
-        self.graph.add_node(root)
-        if "Plans" not in query:
+        if file_format == "svg":
+            with open(file_name, "w") as f:
+                f.write(self.render_svg())
             return
-        for child in query["Plans"]:
-            child_node = self.create_node(child)
-            self.graph.add_edge(root, child_node)
-            self.create_graph_node(child_node,child)
-
-    def save_graph_file(self) -> str:
-        """Renders the graph and save the figure as an .png file
-        in the 'static' folder.
-        The frontend then renders the image on the UI to visualise the QEP.
+
+        import networkx as nx
+        plt = load_pyplot()
+        graph = nx.DiGraph()
+        graph.add_nodes_from(self.nodes)
+        graph.add_edges_from(self.edges)
+        node_labels = {x: str(x) for x in self.nodes}
+        with plot_lock:
+            plt.figure(figsize=( 3*(2+2/(1+ math.exp(-self.tree_width))) , self.tree_depth * 1.5))
+            plt.axis('equal')
+            nx.draw(
+                graph,
+                self.positions,
+                with_labels=True,
+                labels=node_labels,
+                font_size=6,
+                node_size=2000,
+                node_color="#E2FAB5",
+                node_shape="s",
+                alpha=1,
+            )
+            plt.savefig(file_name)
+            plt.close()
+
+    def render_svg(self) -> str:
+        """Draws the graph as an SVG document with the same hierarchical layout and node labels
+        as the matplotlib figure, without going through matplotlib.
 
         Returns:
-            str: File name of graph
+            str: SVG document
         """
-        plt.figure(figsize=( 3*(2+2/(1+ math.exp(-self.tree_width))) , self.tree_depth * 1.5))
-        plt.axis('equal')
-        graph_name = f"qep_{str(time.time())}.png"
-        file_name = os.path.join(os.getcwd(), "static", graph_name)
-        plot_formatter_position = get_tree_node_pos(self.graph, self.root)
-        node_labels = {x: str(x) for x in self.graph.nodes}
-        # the_base_size = 100
-        # [len(v.__str__()) * the_base_size for v in self.graph.nodes()]
-        nx.draw(
-            self.graph,
-            plot_formatter_position,
-            with_labels=True,
-            labels=node_labels,
-            font_size=6,
-            node_size=2000,
-            node_color="#E2FAB5",
-            node_shape="s",
-            alpha=1,
-        )
-        plt.savefig(file_name)
-        plt.clf()
-        return graph_name
+        labels = {node: str(node).split("\n") for node in self.nodes}
+        char_width, line_height, pad = 4.5, 9, 6
+        box_width = max(60, max(char_width * len(line) for lines in labels.values() for line in lines) + 2 * pad)
+        box_height = max(len(lines) for lines in labels.values()) * line_height + 2 * pad
+        # nodes on the same level are at least one layout unit apart
+        x_scale, y_scale = box_width + 20, box_height + 40
+        xs = [x for x, _ in self.positions.values()]
+        left = min(xs)
+
+        def point(node):
+            x, y = self.positions[node]
+            return (x - left) * x_scale + box_width / 2 + 10, -y * y_scale + box_height / 2 + 10
+
+        width = (max(xs) - left) * x_scale + box_width + 20
+        height = self.tree_depth * y_scale - 20
+        parts = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height:.0f}" '
+            f'viewBox="0 0 {width:.0f} {height:.0f}" font-family="sans-serif" font-size="8">',
+            '<defs><marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="6" markerHeight="6" '
+            'orient="auto"><path d="M0,0 L10,5 L0,10 z"/></marker></defs>'
+        ]
+        for parent, child in self.edges:
+            (x1, y1), (x2, y2) = point(parent), point(child)
+            parts.append(f'<line x1="{x1:.1f}" y1="{y1 + box_height / 2:.1f}" x2="{x2:.1f}" '
+                         f'y2="{y2 - box_height / 2:.1f}" stroke="black" marker-end="url(#arrow)"/>')
+        for node, lines in labels.items():
+            x, y = point(node)
+            parts.append(f'<rect x="{x - box_width / 2:.1f}" y="{y - box_height / 2:.1f}" width="{box_width:.0f}" '
+                         f'height="{box_height:.0f}" fill="#E2FAB5"/>')
+            top = y - (len(lines) - 1) * line_height / 2 + 3
+            tspans = "".join(f'<tspan x="{x:.1f}" y="{top + i * line_height:.1f}">{html.escape(line)}</tspan>'
+                             for i, line in enumerate(lines))
+            parts.append(f'<text text-anchor="middle">{tspans}</text>')
+        parts.append('</svg>')
+        return "".join(parts)
 
     def get_num_nodes(self) -> int:
         """Returns the number of nodes in the graph.
         Returns:
             int: Number of nodes
         """     
-        return len(self.graph.nodes)
+        return len(self.nodes)
 
-def get_tree_node_pos(G, root=None, width=1.0, height=1, vert_gap=0.2, vert_loc=0, xcenter=0.5):
-    """From Joel's answer at https://stackoverflow.com/a/29597209/2966723.
-    Licensed under Creative Commons Attribution-Share Alike
-
-    Recursive program to define the positions. The recursion happens in _hierarchy_pos, which is called by get_tree_node_pos.
-    The main role of hierarchy_pos is to do a bit of testing to make sure the graph is appropriate before entering the recursion.
-
-    If the graph is a tree this will return the positions to plot this in a hierarchical layout.
+def tree_layout(plan, create_node, add_edge):
+    """Lays out a plan tree in two O(n) passes over the arrays of its PlanTree.
+    Leaves take consecutive horizontal slots and every parent is centred above its first and last child,
+    so nodes on the same level never overlap. Depth and width are computed in the same passes, and no
+    state is kept between calls.
 
     Args:
-        G (DiGraph): The graph (must be a tree).
-        root (Node, optional): The root node of the current branch.
-        - If the tree is directed and this is not given, the root will be found and used.
-        - If the tree is directed and this is given, the positions will be just for the descendants of this node.
-        - If the tree is undirected and not given, a random choice will be used.
-        Defaults to None.
-        width (float, optional): Horizontal space allocated for this branch. Defaults to 1.0.
-        height (int, optional): Vertical space allocated for this branch. Defaults to 1.
-        vert_gap (float, optional):  Gap between levels of hierarchy. Defaults to 0.1.
-        vert_loc (int, optional): Vertical location of root. Defaults to 0.
-        xcenter (float, optional): Horizontal location of root. Defaults to 0.5.
-
-    Raises:
-        TypeError: Graph is not a tree.
+        plan (PlanNode): Root of the plan, a plan dict is converted to a PlanTree first
+        create_node (callable): Creates the node object of a plan node
+        add_edge (callable): Called with (parent, child) for every edge
 
     Returns:
-        dict: [description]
+        tuple: Root node, dict of node to (x, y) position with y = -level, tree depth, tree width
     """
-
-    if not nx.is_tree(G):
-        raise TypeError("cannot use hierarchy_pos on a graph that is not a tree")
-
-    if root is None:
-        if isinstance(G, nx.DiGraph):
-            root = next(iter(nx.topological_sort(G)))  # allows back compatibility with nx version 1.11
-        else:
-            root = random.choice(list(G.nodes))
-
-    path_dict = dict(nx.all_pairs_shortest_path(G))
-    max_height = 0
-    for value in path_dict.values():
-        max_height = max(max_height, len(value))
-    vert_gap = height / max_height
-
-    def _hierarchy_pos(G, root, width=1., vert_gap = 0.2, vert_loc = 0, xcenter = 0.5, min_dx=0.05 ):
-        '''If there is a cycle that is reachable from root, then result will not be a hierarchy.
-
-        G: the graph
-        root: the root node of current branch
-        width: horizontal space allocated for this branch - avoids overlap with other branches
-        vert_gap: gap between levels of hierarchy
-        vert_loc: vertical location of root
-        xcenter: horizontal location of root
-        '''
-
-        def h_recur(G, root, width=width, vert_gap = vert_gap, vert_loc = vert_loc, xcenter = xcenter, 
-                    pos = None, parent = None, parsed = [] ):
-            if(root not in parsed):
-                parsed.append(root)
-                if pos == None:
-                    pos = {root:(xcenter * 2,vert_loc)}
-                else:
-                    pos[root] = (xcenter * 2, vert_loc)
-                neighbors = list(G.neighbors(root))
-                if not isinstance(G, nx.DiGraph) and parent != None:
-                    neighbors.remove(parent)
-                if len(neighbors)!=0:
-                    dx = max(min_dx, width / len(neighbors))
-                    nextx = xcenter - width / 2 - max(min_dx, dx / 2)
-                    for neighbor in neighbors:
-                        nextx += dx
-                        pos = h_recur(G,neighbor, width = dx, vert_gap = vert_gap, 
-                                            vert_loc = vert_loc-vert_gap, xcenter=nextx, pos=pos, 
-                                            parent = root, parsed = parsed)
-            return pos
-        return h_recur(G, root, width=width, vert_gap = 0.2, vert_loc = vert_loc, xcenter = xcenter)
-    return _hierarchy_pos(G, root, width, vert_gap, vert_loc, xcenter)
+    if isinstance(plan, dict):
+        plan = PlanTree.fromPlan(plan)["Plan"]
+    tree, first = plan.tree, plan.index
+    ends = tree.ends
+    count = ends[first] - first
+    nodes = [create_node(tree.node(first + k)) for k in range(count)]
+    levels = [0] * count
+    xs = [0.0] * count
+    last_child = [0] * count
+    level_counts = []
+    next_leaf = 0
+    # pre-order: parents come before their children and leaves from left to right
+    for k in range(count):
+        level = levels[k]
+        if len(level_counts) <= level:
+            level_counts.append(0)
+        level_counts[level] += 1
+        child = first + k + 1
+        if child == ends[first + k]:
+            xs[k] = next_leaf
+            next_leaf += 1
+            continue
+        while child < ends[first + k]:
+            levels[child - first] = level + 1
+            add_edge(nodes[k], nodes[child - first])
+            last_child[k] = child - first
+            child = ends[child]
+    # reverse pre-order: children are placed before their parent
+    for k in range(count - 1, -1, -1):
+        if last_child[k]:
+            xs[k] = (xs[k + 1] + xs[last_child[k]]) / 2
+    positions = {node: (x, -level) for node, x, level in zip(nodes, xs, levels)}
+    return nodes[0], positions, len(level_counts), max(level_counts)
@@ -0,0 +1,140 @@
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    """
+    Counters and histograms of the application, rendered in the Prometheus text exposition format
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.help = {}
+        self.buckets = {}
+        self.values = {}
+
+    def counter(self, name, help):
+        """
+        Declares a counter
+        :param name: metric name
+        :param help: description of the metric
+        :return: None
+        """
+        self.kinds[name] = "counter"
+        self.help[name] = help
+
+    def gauge(self, name, help):
+        """
+        Declares a gauge
+        :param name: metric name
+        :param help: description of the metric
+        :return: None
+        """
+        self.kinds[name] = "gauge"
+        self.help[name] = help
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        """
+        Declares a histogram
+        :param name: metric name
+        :param help: description of the metric
+        :param buckets: upper bounds of the buckets
+        :return: None
+        """
+        self.kinds[name] = "histogram"
+        self.help[name] = help
+        self.buckets[name] = tuple(buckets)
+
+    def increment(self, name, value=1, **labels):
+        """
+        Adds to a counter
+        :param name: metric name
+        :param value: amount to add
+        :param labels: label values of the series
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Sets a gauge
+        :param name: metric name
+        :param value: current value
+        :param labels: label values of the series
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value in a histogram
+        :param name: metric name
+        :param value: observed value
+        :param labels: label values of the series
+        :return: None
+        """
+        key = (name, tuple(sorted(labels.items())))
+        bounds = self.buckets[name]
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * len(bounds), 0.0, 0]
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        """
+        Renders every series in the Prometheus text format
+        :return: text
+        """
+        with self.lock:
+            values = sorted((key, value if not isinstance(value, list) else [list(value[0]), value[1], value[2]])
+                            for key, value in self.values.items())
+        lines = []
+        for name in sorted(self.kinds):
+            lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {self.kinds[name]}")
+            for (series, labels), value in values:
+                if series != name:
+                    continue
+                if self.kinds[name] != "histogram":
+                    lines.append(f"{name}{formatLabels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                for bound, bucketCount in zip(self.buckets[name], counts):
+                    lines.append(f"{name}_bucket{formatLabels(labels + (('le', bound),))} {bucketCount}")
+                lines.append(f"{name}_bucket{formatLabels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{formatLabels(labels)} {total}")
+                lines.append(f"{name}_count{formatLabels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def formatLabels(labels):
+    """
+    Formats label pairs as {name="value",...}
+    :param labels: tuple of (name, value)
+    :return: label text, empty without labels
+    """
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+# shared by every request of the process
+registry = Metrics()
+registry.counter("aqp_requests_total", "Analysed queries by outcome")
+registry.histogram("aqp_stage_seconds", "Time spent in each stage of an analysis")
+registry.counter("aqp_explains_total", "EXPLAIN statements sent to the database")
+registry.counter("aqp_distinct_plans_total", "Distinct plans found by the AQP enumeration")
+registry.counter("aqp_db_round_trips_total", "Statements sent to the database")
+registry.counter("aqp_db_round_trip_seconds_total", "Time spent waiting for the database")
+registry.counter("aqp_planner_seconds_total", "Planning time reported by the database for the explained plans")
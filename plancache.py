@@ -0,0 +1,156 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from plantree import PlanTree
+
+
+class PlanCache:
+    """
+    Two tier cache of query plans keyed by normalized query, database and planner method configuration.
+    Plans are kept as PlanTree in an in-memory LRU and optionally persisted as JSON to a SQLite file.
+    """
+    def __init__(self, capacity=50000, path=None):
+        """
+        Creates the cache
+        :param capacity: maximum number of plans held in memory
+        :param path: SQLite file for the on-disk tier, None to keep plans in memory only
+        """
+        self.capacity = capacity
+        self.memory = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.disk = None
+        if path:
+            self.disk = sqlite3.connect(path, check_same_thread=False)
+            self.disk.execute("CREATE TABLE IF NOT EXISTS plans ("
+                              "db TEXT, stats TEXT, query TEXT, settings TEXT, plan TEXT, "
+                              "PRIMARY KEY (db, query, settings))")
+            self.disk.commit()
+
+    @staticmethod
+    def normalize(query):
+        """
+        Normalizes a query so that formatting differences map to the same cache entry
+        :param query: SQL query
+        :return: normalized query text
+        """
+        # imported on first use, sqlparse takes longer to import than the rest of the cache
+        import sqlparse
+        from sqlparse import tokens as T
+        query = sqlparse.format(query, strip_comments=True, keyword_case='upper')
+        # only whitespace between tokens and inside keywords and operators like GROUP BY or NOT LIKE is
+        # collapsed, literals and quoted identifiers are kept as written
+        parts = []
+        for token in (token for statement in sqlparse.parse(query) for token in statement.flatten()):
+            if token.ttype in T.Whitespace:
+                if parts and parts[-1] != " ":
+                    parts.append(" ")
+            elif token.ttype in T.Keyword or token.ttype in T.Operator:
+                parts.append(" ".join(token.value.split()))
+            else:
+                parts.append(token.value)
+        return "".join(parts).strip().rstrip(";").strip()
+
+    def queryDigest(self, query):
+        """
+        Hashes the normalized query text
+        :param query: SQL query
+        :return: hex digest
+        """
+        return hashlib.sha1(self.normalize(query).encode()).hexdigest()
+
+    def makeKey(self, dbName, statsVersion, digest, settings):
+        """
+        Builds the cache key of a plan
+        :param dbName: database name
+        :param statsVersion: statistics version the plan was generated with
+        :param digest: query digest from queryDigest
+        :param settings: planner method configuration, e.g. the bitstring of the combination
+        :return: key tuple
+        """
+        return dbName, str(statsVersion), digest, str(settings)
+
+    def checkVersion(self, dbName, statsVersion):
+        """
+        Drops every plan of a database that was generated with other statistics
+        :param dbName: database name
+        :param statsVersion: current statistics version
+        :return: None
+        """
+        statsVersion = str(statsVersion)
+        with self.lock:
+            if self.versions.get(dbName) == statsVersion:
+                return
+            self.versions[dbName] = statsVersion
+            for key in [k for k in self.memory if k[0] == dbName and k[1] != statsVersion]:
+                del self.memory[key]
+            if self.disk is not None:
+                self.disk.execute("DELETE FROM plans WHERE db = ? AND stats != ?", (dbName, statsVersion))
+                self.disk.commit()
+
+    def get(self, key):
+        """
+        Looks up a plan
+        :param key: key from makeKey
+        :return: plan, or None when not cached
+        """
+        with self.lock:
+            plan = self.memory.get(key)
+            if plan is not None:
+                self.memory.move_to_end(key)
+                return plan
+            if self.disk is None:
+                return None
+            row = self.disk.execute("SELECT plan FROM plans WHERE db = ? AND stats = ? AND query = ? AND settings = ?",
+                                    key).fetchone()
+            if row is None:
+                return None
+            plan = PlanTree(json.loads(row[0]))
+            self.remember(key, plan)
+            return plan
+
+    def put(self, key, plan):
+        """
+        Stores a plan
+        :param key: key from makeKey
+        :param plan: PlanTree to store
+        :return: None
+        """
+        self.putMany([(key, plan)])
+
+    def putMany(self, items):
+        """
+        Stores several plans at once
+        :param items: list of (key, PlanTree)
+        :return: None
+        """
+        with self.lock:
+            for key, plan in items:
+                self.remember(key, plan)
+            if self.disk is not None and items:
+                self.disk.executemany("INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?, ?)",
+                                      [(*key, json.dumps(plan.toExplain())) for key, plan in items])
+                self.disk.commit()
+
+    def remember(self, key, plan):
+        """
+        Adds a plan to the in-memory LRU, evicting the least recently used plans. Caller holds the lock.
+        :param key: key from makeKey
+        :param plan: plan to store
+        :return: None
+        """
+        self.memory[key] = plan
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def close(self):
+        """
+        Closes the on-disk tier
+        :return: None
+        """
+        if self.disk is not None:
+            self.disk.close()
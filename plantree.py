@@ -0,0 +1,223 @@
+import sys
+from array import array
+
+from fingerprint import DIGEST_SIZE, treeFingerprints
+
+# node fields held in their own arrays, every other field is kept in the per node details
+COLUMNS = ("Node Type", "Relation Name", "Startup Cost", "Total Cost", "Plan Rows")
+# join node type -> key of the join condition held in the conditions array
+CONDITIONS = {"Hash Join": "Hash Cond", "Merge Join": "Merge Cond"}
+# fields not kept in the details, per node type
+SKIPPED = {nodeType: frozenset(COLUMNS + ("Plans", condition)) for nodeType, condition in CONDITIONS.items()}
+SKIPPED[None] = frozenset(COLUMNS + ("Plans",))
+MISSING = object()
+
+
+def intern(value):
+    """
+    Interns the strings of a plan field, so that equal strings of different plans share one object
+    :param value: field value decoded from JSON
+    :return: value with interned strings, lists become tuples
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return tuple(intern(v) for v in value)
+    if isinstance(value, dict):
+        return {sys.intern(k): intern(v) for k, v in value.items()}
+    return value
+
+
+class PlanTree:
+    """
+    Compact form of an EXPLAIN (FORMAT JSON) result. The nodes are numbered in pre-order and their fields are held in
+    parallel arrays: costs and rows in numeric arrays, node types, relations and join conditions as interned strings.
+    The subtree of node i spans the nodes i to ends[i] - 1, so its first child is i + 1 and every next sibling
+    starts at the end of the previous one. Nodes are read through PlanNode views, which behave like the plan dicts.
+    """
+    __slots__ = ("types", "relations", "conditions", "startupCosts", "totalCosts", "planRows", "ends", "details",
+                 "summary", "digests", "fingerprint")
+
+    def __init__(self, explain):
+        """
+        Converts an EXPLAIN result
+        :param explain: EXPLAIN result as decoded from JSON, {"Plan": ..., "Planning Time": ...}
+        """
+        self.types = []
+        self.relations = []
+        self.conditions = []
+        self.startupCosts = array("d")
+        self.totalCosts = array("d")
+        self.planRows = array("q")
+        self.ends = array("i")
+        self.details = []
+        # fields of the EXPLAIN result besides the plan, e.g. "Planning Time"
+        self.summary = {sys.intern(k): v for k, v in explain.items() if k != "Plan"}
+
+        stack = [(explain["Plan"], False)]
+        # nodes whose subtree is still being added
+        pending = []
+        while stack:
+            node, done = stack.pop()
+            if done:
+                self.ends[pending.pop()] = len(self.types)
+                continue
+            nodeType = node["Node Type"]
+            skipped = SKIPPED.get(nodeType, SKIPPED[None])
+            pending.append(len(self.types))
+            self.types.append(sys.intern(nodeType))
+            relation = node.get("Relation Name")
+            self.relations.append(sys.intern(relation) if relation is not None else None)
+            condition = node.get(CONDITIONS.get(nodeType))
+            self.conditions.append(sys.intern(condition) if condition is not None else None)
+            self.startupCosts.append(node.get("Startup Cost", 0.0))
+            self.totalCosts.append(node["Total Cost"])
+            self.planRows.append(round(node.get("Plan Rows", 0)))
+            self.ends.append(0)
+            details = {}
+            for key, value in node.items():
+                if key not in skipped:
+                    details[sys.intern(key)] = sys.intern(value) if type(value) is str else intern(value)
+            self.details.append(details or None)
+            stack.append((node, True))
+            for child in reversed(node.get("Plans", ())):
+                stack.append((child, False))
+        # structural fingerprint of every subtree, the one of the root identifies the plan
+        self.digests = treeFingerprints(self)
+        self.fingerprint = self.digests[:DIGEST_SIZE]
+
+    @classmethod
+    def fromPlan(cls, plan):
+        """
+        Converts a plan dict without the surrounding EXPLAIN result
+        :param plan: root node of the plan
+        :return: PlanTree
+        """
+        return cls({"Plan": plan})
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, key):
+        if key == "Plan":
+            return PlanNode(self, 0)
+        return self.summary[key]
+
+    def __contains__(self, key):
+        return key == "Plan" or key in self.summary
+
+    def get(self, key, default=None):
+        if key == "Plan":
+            return PlanNode(self, 0)
+        return self.summary.get(key, default)
+
+    def node(self, index):
+        """
+        View of a node
+        :param index: pre-order number of the node
+        :return: PlanNode
+        """
+        return PlanNode(self, index)
+
+    def children(self, index):
+        """
+        Pre-order numbers of the child nodes of a node
+        :param index: pre-order number of the node
+        :return: list of child numbers
+        """
+        children = []
+        child = index + 1
+        end = self.ends[index]
+        while child < end:
+            children.append(child)
+            child = self.ends[child]
+        return children
+
+    def subtreeFingerprint(self, index):
+        """
+        Structural fingerprint of a subtree, equal for equal subtrees of any plan
+        :param index: pre-order number of the subtree root
+        :return: 16 byte fingerprint
+        """
+        return self.digests[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+
+    def toPlan(self, index=0):
+        """
+        Rebuilds the plan dict of a subtree, e.g. to write it as JSON
+        :param index: pre-order number of the subtree root
+        :return: plan dict
+        """
+        node = {"Node Type": self.types[index], "Startup Cost": self.startupCosts[index],
+                "Total Cost": self.totalCosts[index], "Plan Rows": self.planRows[index]}
+        if self.relations[index] is not None:
+            node["Relation Name"] = self.relations[index]
+        if self.conditions[index] is not None:
+            node[CONDITIONS[self.types[index]]] = self.conditions[index]
+        for key, value in (self.details[index] or {}).items():
+            node[key] = list(value) if isinstance(value, tuple) else value
+        children = self.children(index)
+        if children:
+            node["Plans"] = [self.toPlan(child) for child in children]
+        return node
+
+    def toExplain(self):
+        """
+        Rebuilds the EXPLAIN result
+        :return: {"Plan": ..., "Planning Time": ...}
+        """
+        return {"Plan": self.toPlan(), **self.summary}
+
+
+class PlanNode:
+    """
+    Read only view of one node of a PlanTree with the interface of a plan dict: node["Total Cost"], "Filter" in node,
+    node.get("Alias") and node["Plans"], which lists views of the child nodes.
+    """
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def get(self, key, default=None):
+        tree, index = self.tree, self.index
+        if key == "Node Type":
+            return tree.types[index]
+        if key == "Total Cost":
+            return tree.totalCosts[index]
+        if key == "Startup Cost":
+            return tree.startupCosts[index]
+        if key == "Plan Rows":
+            return tree.planRows[index]
+        if key == "Relation Name":
+            value = tree.relations[index]
+        elif key == "Plans":
+            value = [PlanNode(tree, child) for child in tree.children(index)] or None
+        elif key == CONDITIONS.get(tree.types[index]):
+            value = tree.conditions[index]
+        else:
+            details = tree.details[index]
+            value = details.get(key) if details is not None else None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def __eq__(self, other):
+        return isinstance(other, PlanNode) and other.tree is self.tree and other.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def toPlan(self):
+        """
+        Rebuilds the plan dict of the subtree of this node
+        :return: plan dict
+        """
+        return self.tree.toPlan(self.index)
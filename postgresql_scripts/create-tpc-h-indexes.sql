@@ -0,0 +1,9 @@
+-- Indexes on the foreign key columns of TPC-H that are not already covered by a primary key.
+-- Every statement builds its index concurrently, so they can run in parallel and outside a transaction.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS nation_n_regionkey_idx ON public.nation (n_regionkey);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS supplier_s_nationkey_idx ON public.supplier (s_nationkey);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS customer_c_nationkey_idx ON public.customer (c_nationkey);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS partsupp_ps_suppkey_idx ON public.partsupp (ps_suppkey);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_o_custkey_idx ON public.orders (o_custkey);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS lineitem_l_partkey_l_suppkey_idx ON public.lineitem (l_partkey, l_suppkey);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS lineitem_l_suppkey_idx ON public.lineitem (l_suppkey);
@@ -0,0 +1,327 @@
+import argparse
+import configparser
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+TABLES = ["region", "nation", "part", "supplier", "partsupp", "customer", "orders", "lineitem"]
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+# read by preprocessing.QueryAnalyzer.checkStats, so that plans cached before the last ANALYZE are dropped.
+# This is the only definition of the table, it is created by the first provisioning of a database.
+STATS_VERSION = """
+CREATE TABLE IF NOT EXISTS public.stats_version (
+    version integer PRIMARY KEY,
+    analyzed_at timestamp with time zone NOT NULL DEFAULT now()
+);
+INSERT INTO public.stats_version (version) SELECT coalesce(max(version), 0) + 1 FROM public.stats_version RETURNING version
+"""
+
+# tables whose statistics are missing or older than their last change. Before PostgreSQL 15 the statistics
+# collector reports an ANALYZE asynchronously, so a table may show up here shortly after it was analyzed.
+STALE_STATS = """
+SELECT relname FROM pg_stat_user_tables
+WHERE relname = ANY(%s) AND (coalesce(last_analyze, last_autoanalyze) IS NULL OR n_mod_since_analyze > 0)
+ORDER BY relname
+"""
+
+# primary keys first, foreign keys need the referenced key to exist
+SAVED_CONSTRAINTS = """
+SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid), contype
+FROM pg_constraint
+WHERE conrelid = ANY(%s::regclass[]) AND contype IN ('p', 'u', 'f')
+ORDER BY contype = 'f', conname
+"""
+
+# indexes that do not belong to a constraint
+SAVED_INDEXES = """
+SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid)
+FROM pg_index i
+WHERE i.indrelid = ANY(%s::regclass[])
+  AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)
+"""
+
+
+class TblReader:
+    """File-like view of a dbgen .tbl file that drops the trailing '|' of every row while it is read.
+    Only one chunk of the file, the incomplete row at its end and the bytes not yet returned are held in memory."""
+
+    def __init__(self, path, chunk_size=1 << 20):
+        self.file = open(path, "rb")
+        self.chunk_size = chunk_size
+        self.rest = b""
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        """Returns the next bytes of the converted file, rows may be split between calls.
+
+        Args:
+            size (int, optional): Maximum number of bytes, all remaining bytes if negative. Defaults to -1.
+
+        Returns:
+            bytes: Converted data, empty at the end of the file
+        """
+        while size < 0 or len(self.buffer) < size:
+            rows = self.rows()
+            if not rows:
+                break
+            self.buffer += rows
+        if size < 0 or size >= len(self.buffer):
+            data, self.buffer = bytes(self.buffer), bytearray()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def rows(self):
+        """Reads the complete rows of the next chunk and drops their trailing '|'.
+
+        Returns:
+            bytes: Converted rows, empty at the end of the file
+        """
+        while True:
+            chunk = self.file.read(self.chunk_size)
+            if not chunk:
+                data, self.rest = self.rest, b""
+                if data and not data.endswith(b"\n"):
+                    data += b"\n"
+                return data.replace(b"|\r\n", b"\n").replace(b"|\n", b"\n")
+            data = self.rest + chunk
+            end = data.rfind(b"\n") + 1
+            if end == 0:
+                self.rest = data
+                continue
+            self.rest = data[end:]
+            return data[:end].replace(b"|\r\n", b"\n").replace(b"|\n", b"\n")
+
+    def close(self):
+        self.file.close()
+
+
+def connect(config):
+    """Opens an autocommit connection with the settings of database.ini, without a statement timeout.
+
+    Args:
+        config (ConfigParser): Parsed database.ini
+
+    Returns:
+        connection: psycopg2 connection
+    """
+    conn = psycopg2.connect(
+        host=config['postgresql']['host'],
+        database=config['postgresql']['database'],
+        user=config['postgresql']['user'],
+        password=config['postgresql']['password'],
+        port=config['postgresql']['port']
+    )
+    conn.set_isolation_level(0)
+    return conn
+
+
+def report(message):
+    """Prints a progress line in a single write, so that lines of parallel workers do not interleave.
+
+    Args:
+        message (str): Progress message
+    """
+    sys.stdout.write(message + "\n")
+    sys.stdout.flush()
+
+
+def run_statements(config, groups, jobs):
+    """Runs groups of statements in parallel, one connection per group. The statements of a group run in order.
+
+    Args:
+        config (ConfigParser): Parsed database.ini
+        groups (list): Lists of SQL statements
+        jobs (int): Number of groups run at the same time
+    """
+    def run(statements):
+        conn = connect(config)
+        try:
+            with conn.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+                    report(f"done: {statement}")
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(run, groups))
+
+
+def load_table(config, table, path, chunk_size):
+    """Streams one .tbl file into its table with COPY FROM STDIN. The table is truncated in the same
+    transaction, so the rows are written frozen.
+
+    Args:
+        config (ConfigParser): Parsed database.ini
+        table (str): Table name
+        path (str): Path of the .tbl file
+        chunk_size (int): Bytes read from the file at a time
+
+    Returns:
+        float: Seconds taken
+    """
+    start = time.perf_counter()
+    conn = connect(config)
+    conn.autocommit = False
+    reader = TblReader(path, chunk_size)
+    try:
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"TRUNCATE {table}")
+                cursor.copy_expert(f"COPY {table} FROM STDIN WITH (FORMAT text, DELIMITER '|', FREEZE)",
+                                   reader, size=chunk_size)
+    finally:
+        reader.close()
+        conn.close()
+    seconds = time.perf_counter() - start
+    report(f"loaded {table} from {path} in {seconds:.1f}s")
+    return seconds
+
+
+def load(directory, config, jobs=4, chunk_size=1 << 20, schema=None):
+    """Loads every TPC-H .tbl file of a directory. Constraints and indexes of the tables are dropped, the tables are
+    loaded in parallel, largest first, and the constraints and indexes are created again afterwards.
+
+    Args:
+        directory (str): Directory of the .tbl files
+        config (ConfigParser): Parsed database.ini
+        jobs (int, optional): Number of tables loaded at the same time. Defaults to 4.
+        chunk_size (int, optional): Bytes read from a file at a time. Defaults to 1 MiB.
+        schema (str, optional): SQL file creating the tables, run first if given. Defaults to None.
+    """
+    files = {table: os.path.join(directory, f"{table}.tbl") for table in TABLES
+             if os.path.exists(os.path.join(directory, f"{table}.tbl"))}
+    if not files:
+        raise SystemExit(f"no TPC-H .tbl files in {directory}")
+
+    conn = connect(config)
+    try:
+        with conn.cursor() as cursor:
+            if schema:
+                cursor.execute("DROP TABLE IF EXISTS " + ", ".join(reversed(TABLES)) + ", stats_version CASCADE")
+                with open(schema) as f:
+                    cursor.execute(f.read())
+            cursor.execute(SAVED_CONSTRAINTS, (TABLES,))
+            constraints = cursor.fetchall()
+            cursor.execute(SAVED_INDEXES, (TABLES,))
+            indexes = cursor.fetchall()
+            for table, name, _, _ in reversed(constraints):
+                cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+            for name, _ in indexes:
+                cursor.execute(f"DROP INDEX {name}")
+    finally:
+        conn.close()
+
+    restore = [[f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'
+                for table, name, definition, kind in constraints if kind != 'f'] + [definition for _, definition in indexes],
+               [f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'
+                for table, name, definition, kind in constraints if kind == 'f']]
+    try:
+        largest_first = sorted(files, key=lambda table: os.path.getsize(files[table]), reverse=True)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(lambda table: load_table(config, table, files[table], chunk_size), largest_first))
+    except Exception:
+        print("loading failed, the dropped constraints and indexes are:", file=sys.stderr)
+        print(";\n".join(restore[0] + restore[1]) + ";", file=sys.stderr)
+        raise
+
+    # keys and indexes are built once over the loaded rows, then the foreign keys are validated against them
+    for statements in restore:
+        run_statements(config, [[statement] for statement in statements], jobs)
+
+
+def stale_tables(cursor, tables, attempts=10, delay=0.2):
+    """Lists the tables whose statistics are stale, waiting for analyzed tables to be reported as such.
+
+    Args:
+        cursor (cursor): Cursor of an autocommit connection
+        tables (list): Table names
+        attempts (int, optional): Number of times the statistics are read. Defaults to 10.
+        delay (float, optional): Seconds waited between attempts. Defaults to 0.2.
+
+    Returns:
+        list: Names of the tables still stale after the last attempt
+    """
+    for attempt in range(attempts):
+        # drop the statistics cached by this backend, so that the next read sees the latest reports
+        cursor.execute("SELECT pg_stat_clear_snapshot()")
+        cursor.execute(STALE_STATS, (tables,))
+        stale = [row[0] for row in cursor.fetchall()]
+        if not stale or attempt == attempts - 1:
+            return stale
+        time.sleep(delay)
+
+
+def provision(config, jobs=4, indexes=os.path.join(SCRIPTS, "create-tpc-h-indexes.sql")):
+    """Prepares loaded tables for planning: builds the foreign key indexes concurrently, analyzes every table in
+    parallel, checks that no table is left with stale statistics and records a new statistics version.
+
+    Args:
+        config (ConfigParser): Parsed database.ini
+        jobs (int, optional): Number of statements run at the same time. Defaults to 4.
+        indexes (str, optional): SQL file of CREATE INDEX CONCURRENTLY statements. Defaults to create-tpc-h-indexes.sql.
+
+    Returns:
+        int: The recorded statistics version
+    """
+    with open(indexes) as f:
+        script = "\n".join(line for line in f if not line.lstrip().startswith("--"))
+    # concurrent builds on the same table wait for each other's transactions, so they run one after another
+    groups = {}
+    for statement in (s.strip() for s in script.split(";")):
+        if statement:
+            groups.setdefault(re.search(r"\bON\s+([\w.]+)", statement, re.IGNORECASE).group(1), []).append(statement)
+    run_statements(config, list(groups.values()), jobs)
+
+    conn = connect(config)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT t FROM unnest(%s::text[]) t WHERE to_regclass(t) IS NOT NULL", (TABLES,))
+            tables = [row[0] for row in cursor.fetchall()]
+            run_statements(config, [[f"ANALYZE {table}"] for table in tables], jobs)
+            stale = stale_tables(cursor, tables)
+            if stale:
+                print(f"warning: statistics of {', '.join(stale)} changed while analyzing", file=sys.stderr)
+            cursor.execute(STATS_VERSION)
+            version = cursor.fetchone()[0]
+    finally:
+        conn.close()
+    report(f"recorded statistics version {version}")
+    return version
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream TPC-H .tbl files into PostgreSQL with COPY, then index and analyze the tables.")
+    parser.add_argument("directory", nargs="?", help="directory of the .tbl files generated by dbgen")
+    parser.add_argument("--config", default="database.ini", help="database settings (default: database.ini)")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="tables loaded or statements run at the same time (default: 4)")
+    parser.add_argument("--chunk-size", type=int, default=1 << 20, help="bytes read at a time (default: 1048576)")
+    parser.add_argument("--schema", nargs="?", const=os.path.join(SCRIPTS, "create-tpc-h-tables.sql"),
+                        help="drop and create the tables first, with create-tpc-h-tables.sql unless another file is given")
+    parser.add_argument("--no-provision", action="store_true", help="skip building the foreign key indexes and analyzing")
+    args = parser.parse_args(argv)
+    if args.directory is None and args.no_provision:
+        parser.error("nothing to do without a directory and with --no-provision")
+
+    config = configparser.ConfigParser()
+    if not config.read(args.config):
+        raise SystemExit(f"cannot read {args.config}")
+    start = time.perf_counter()
+    # without a directory only the provisioning step runs, e.g. after loading CSV files with \copy
+    if args.directory is not None:
+        load(args.directory, config, args.jobs, args.chunk_size, args.schema)
+    if not args.no_provision:
+        provision(config, args.jobs)
+    print(f"finished in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,88 @@
 import psycopg2
+import psycopg2.errors
 import configparser
+import threading
+import time
 import json
-from annotation import Annotation
+import heapq
+import re
+import traceback
+from collections import Counter
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from annotation import Annotation, NODE_TYPES, UNKNOWN_NODE, SCAN_NODE, JOIN_NODE, operatorCost
+from dbpool import ConnectionPool
+from plancache import PlanCache
+from plantree import PlanTree
+from searchspace import SearchSpace
+
+
+# Explains a query once per element of a JSON array of planner settings. set_config(..., true) keeps every
+# setting local to the calling statement, so the session's own configuration is left untouched.
+PROBE_FUNCTION = """
+CREATE FUNCTION pg_temp.aqp_probe(q text, settings json)
+RETURNS TABLE (idx integer, plan json) LANGUAGE plpgsql AS $$
+DECLARE
+    s json;
+    k text;
+    v text;
+BEGIN
+    idx := 0;
+    FOR s IN SELECT * FROM json_array_elements(settings) LOOP
+        FOR k, v IN SELECT * FROM json_each_text(s) LOOP
+            PERFORM set_config(k, v, true);
+        END LOOP;
+        EXECUTE 'EXPLAIN (SUMMARY, FORMAT JSON) ' || q INTO plan;
+        RETURN NEXT;
+        idx := idx + 1;
+    END LOOP;
+END
+$$
+"""
+
+# first keyword of a statement, after comments and opening parentheses
+FIRST_KEYWORD = re.compile(r"(?:\s+|--[^\n]*|/\*.*?\*/|\()*(\w*)", re.DOTALL)
+
+INVALID_QUERY = "Invalid SQL Query or Query Timeout!"
+
+
+def isSingleStatement(query):
+    """
+    Checks that a query holds exactly one statement. psycopg2 sends the text as one simple query, so every statement
+    after the first would be executed, even behind EXPLAIN.
+    :param query: SQL text
+    :return: True for a single statement, comments and a trailing semicolon aside
+    """
+    # imported on first use, like in PlanCache.normalize
+    import sqlparse
+    statements = [s for s in sqlparse.split(query) if sqlparse.format(s, strip_comments=True).strip()]
+    return len(statements) == 1
+
+
+@contextmanager
+def stage(timings, name):
+    """
+    Adds the time spent in the with block to a stage
+    :param timings: stage name -> seconds
+    :param name: stage name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
 
 
 class Database:
     def __init__(self):
         """
-        Starts database connection
+        Loads the database settings. Connections are opened on demand through the connection pools,
+        so a single Database can be shared by concurrent requests.
         """
         self.config = configparser.ConfigParser()
         self.config.read('database.ini')
-        self.conn = psycopg2.connect(
-            host=self.config['postgresql']['host'],
-            database=self.config['postgresql']['database'],
-            user=self.config['postgresql']['user'],
-            password=self.config['postgresql']['password'],
-            port=self.config['postgresql']['port'],
-            connect_timeout=3,
-            keepalives=1,
-            keepalives_idle=5,
-            keepalives_interval=2,
-            keepalives_count=2,
-            options='-c statement_timeout=60000'
-        )
-        self.conn.set_isolation_level(0)
         self.db_name = self.config['postgresql']['database']
-        self.cursor = self.conn.cursor()
         self.possible = ["enable_bitmapscan",
                          "enable_hashagg",
                          "enable_hashjoin",
@@ -38,73 +94,461 @@ class Database:
                          "enable_seqscan",
                          "enable_sort",
                          "enable_tidscan"]
+        # opening a connection is retried with exponential backoff while the server is unreachable
+        retries = self.config.getint('pool', 'retries', fallback=3)
+        backoff = self.config.getfloat('pool', 'backoff', fallback=0.5)
+        # seconds a request waits for a free connection before it fails
+        timeout = self.config.getfloat('pool', 'timeout', fallback=30)
+        # idle connections are pinged before reuse once they were idle for this many seconds
+        self.checkAfter = self.config.getfloat('pool', 'check_after', fallback=30)
+        # connections lent to QueryAnalyzer objects, one per request in flight
+        self.pool = ConnectionPool(self.newConnection, self.config.getint('pool', 'size', fallback=8),
+                                   retries, backoff, (psycopg2.OperationalError,), "analyzer", timeout,
+                                   self.checkConnection, self.resetConnection)
+        # number of connections the AQP enumeration is spread over, 1 == serial on the analyzer's connection
+        self.workers = self.config.getint('aqp', 'workers', fallback=1)
+        self.workerPool = ConnectionPool(self.newConnection, self.workers, retries, backoff, (psycopg2.OperationalError,),
+                                         "aqp", timeout, self.checkConnection, self.resetConnection)
+        # "function" explains [aqp] batch combinations per round trip through a temporary PL/pgSQL function,
+        # "pipelined" sends the SET statements and the EXPLAIN of one combination together, "single" sends them apart
+        self.probe = self.config.get('aqp', 'probe', fallback='function')
+        self.batch = self.config.getint('aqp', 'batch', fallback=256)
+        # "pruned" only toggles flags that can affect the plans found so far, "exhaustive" runs every combination
+        self.search = self.config.get('aqp', 'search', fallback='pruned')
+        # sampled configurations of further settings, e.g. join_collapse_limit, explained after the enable_* flags
+        self.searchSpace = SearchSpace.fromConfig(self.config)
+        # number of distinct AQPs shown next to the QEP, selected over all plans of the search by PlanSelection
+        self.displayPlans = self.config.getint('aqp', 'display', fallback=3)
+        # "cost" shows the cheapest alternatives, "distance" those differing from the QEP in the most nodes
+        self.rank = self.config.get('aqp', 'rank', fallback='cost')
+        # plan node types each planner method configuration can change
+        self.flagNodes = {"enable_bitmapscan": ["Bitmap Heap Scan", "Bitmap Index Scan"],
+                          "enable_hashagg": ["Hashed Aggregate"],
+                          "enable_hashjoin": ["Hash Join"],
+                          "enable_indexscan": ["Index Scan"],
+                          "enable_indexonlyscan": ["Index Only Scan"],
+                          "enable_material": ["Materialize"],
+                          "enable_mergejoin": ["Merge Join"],
+                          "enable_nestloop": ["Nested Loop"],
+                          "enable_seqscan": ["Seq Scan"],
+                          "enable_sort": ["Sort", "Incremental Sort"],
+                          "enable_tidscan": ["Tid Scan", "Tid Range Scan"]}
+        self.cache = PlanCache(capacity=self.config.getint('cache', 'capacity', fallback=50000),
+                               path=self.config.get('cache', 'path', fallback=None))
+        # whether the database has the stats_version table written by postgresql_scripts/load_tpch.py, None until checked
+        self.statsTable = None
+        # "explain" plans the query to validate it, "execute" runs it
+        self.validation = self.config.get('validation', 'mode', fallback='explain')
+        # opt-in EXPLAIN ANALYZE of the QEP and the cheapest distinct AQPs, which executes the query once per plan
+        self.measure = self.config.getboolean('analyze', 'enabled', fallback=False)
+        self.measurePlans = self.config.getint('analyze', 'plans', fallback=3)
+        self.measureTimeout = self.config.getint('analyze', 'timeout', fallback=10000)
+        # executions running at the same time over all requests of the process
+        self.measureSlots = threading.BoundedSemaphore(self.config.getint('analyze', 'concurrency', fallback=1))
         self.annotation = Annotation()
+
+    def newConnection(self):
+        """
+        Opens a new autocommit connection using the settings in database.ini
+        :return: connection
+        """
+        conn = psycopg2.connect(
+            host=self.config['postgresql']['host'],
+            database=self.config['postgresql']['database'],
+            user=self.config['postgresql']['user'],
+            password=self.config['postgresql']['password'],
+            port=self.config['postgresql']['port'],
+            connect_timeout=3,
+            keepalives=1,
+            keepalives_idle=5,
+            keepalives_interval=2,
+            keepalives_count=2,
+            options='-c statement_timeout=60000'
+        )
+        conn.set_isolation_level(0)
+        return conn
+
+    def checkConnection(self, conn, idle):
+        """
+        Checks an idle pooled connection before it is reused. Connections that were closed, e.g. after the server
+        dropped them, or left inside a transaction are refused without a round trip, connections idle for longer
+        than [pool] check_after seconds are pinged.
+        :param conn: idle connection
+        :param idle: seconds since the connection was returned
+        :return: True if the connection can be used
+        """
+        if conn.closed or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if idle >= self.checkAfter:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        return True
+
+    def resetConnection(self, conn):
+        """
+        Restores the session defaults, including the planner method configuration, of a connection returned dirty.
+        Session state that is not a setting, e.g. the temporary probe function, is kept.
+        :param conn: pooled connection
+        :return: None
+        """
+        with conn.cursor() as cursor:
+            cursor.execute("RESET ALL")
+
+    def analyzer(self):
+        """
+        Creates a QueryAnalyzer holding the state of one analysis
+        :return: QueryAnalyzer
+        """
+        return QueryAnalyzer(self)
+
+    def analyse(self, query, callback=None):
+        """
+        Analyses a query on a pooled connection and returns the results as plain data, see QueryAnalyzer.analyse.
+        Failures are reported in the result instead of being raised.
+        :param query: SQL query
+        :param callback: called as callback(analyzer, outcome) after the analysis, outcome being "ok", "invalid"
+                         or "error", e.g. to record metrics
+        :return: dict that can be serialized as JSON
+        """
+        analyzer = None
+        try:
+            analyzer = self.analyzer()
+            result = analyzer.analyse(query)
+            outcome = "ok" if result["valid"] else "invalid"
+        except Exception as e:
+            result = {"query": query, "valid": False,
+                      "error": "".join(traceback.format_exception_only(type(e), e)).strip()}
+            outcome = "error"
+        finally:
+            if analyzer is not None:
+                analyzer.close()
+        if callback is not None and analyzer is not None:
+            callback(analyzer, outcome)
+        return result
+
+    def analyseMany(self, queries, workers=1, callback=None):
+        """
+        Analyses several queries, workers at a time, each on its own pooled connection
+        :param queries: list of SQL queries
+        :param workers: number of queries analysed at the same time
+        :param callback: see analyse
+        :return: list of results, in the order of the queries
+        """
+        if workers <= 1 or len(queries) <= 1:
+            return [self.analyse(query, callback) for query in queries]
+        with ThreadPoolExecutor(max_workers=min(workers, len(queries))) as executor:
+            return list(executor.map(lambda query: self.analyse(query, callback), queries))
+
+    def describeConfiguration(self, configuration):
+        """
+        Lists what a configuration changes from the default planner configuration
+        :param configuration: bitstring or tuple of (setting, value), see configurationMap
+        :return: list of flags turned off, dict of the other settings
+        """
+        settings = self.configurationMap(configuration)
+        return ([flag for flag in self.possible if settings[flag] == "OFF"],
+                {setting: value for setting, value in settings.items() if setting not in self.possible})
+
+    def planNodeTypes(self, qep):
+        """
+        Collects the node types found in a plan. Hashed aggregates are also reported as "Hashed Aggregate".
+        :param qep: PlanTree
+        :return: set of node types
+        """
+        nodes = set(qep.types)
+        if any(nodeType == "Aggregate" and (qep.details[i] or {}).get("Strategy") == "Hashed"
+               for i, nodeType in enumerate(qep.types)):
+            nodes.add("Hashed Aggregate")
+        return nodes
+
+    def settingsMap(self, bitstring):
+        """
+        Decodes one combination of planner method configuration.
+        Each combination is encoded as a bitstring, 1==OFF, 0==ON
+        MSB = enable_bitmapscan, LSB = enable_tidscan
+        :param bitstring: encoded combination
+        :return: dict of flag to "ON"/"OFF"
+        """
+        encode = {
+            1: "OFF",
+            0: "ON"
+        }
+        last = len(self.possible) - 1
+        return {flag: encode[(bitstring >> (last - i)) & 1] for i, flag in enumerate(self.possible)}
+
+    def configurationMap(self, configuration):
+        """
+        Decodes a configuration: a combination of planner method configuration encoded as bitstring, or a
+        configuration sampled from the search space, applied on top of the default planner method configuration.
+        :param configuration: bitstring or tuple of (setting, value)
+        :return: dict of setting to value
+        """
+        if isinstance(configuration, int):
+            return self.settingsMap(configuration)
+        return {**self.settingsMap(0), **dict(configuration)}
+
+    def settingsQuery(self, configuration, local=False):
+        """
+        Builds the SET statements for one configuration.
+        :param configuration: bitstring or tuple of (setting, value), see configurationMap
+        :param local: SET LOCAL, lasting until the end of the current transaction
+        :return: SET statements
+        """
+        command = "SET LOCAL" if local else "SET"
+        # values other than ON/OFF are quoted, e.g. work_mem='4MB'
+        return " ".join(f"{command} {setting}={value};" if value in ("ON", "OFF")
+                        else f"{command} {setting}='{value.replace(chr(39), chr(39) * 2)}';"
+                        for setting, value in self.configurationMap(configuration).items())
+
+    def retrieveAllDbs(self):
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT datname FROM pg_database")
+                dbs = cursor.fetchall()
+        finally:
+            self.pool.putconn(conn)
+        db_list = []
+        for db in dbs:
+            db_list.append(db[0])
+
+        return db_list
+
+    def closeConnection(self):
+        """
+        Close connections to database
+        :return: None
+        """
+        self.pool.closeall()
+        self.workerPool.closeall()
+        self.cache.close()
+
+
+class QueryAnalyzer:
+    """
+    Analysis of a single query. Holds the per request state (scans, joins, AQPs and annotations)
+    on a connection borrowed from the Database pool.
+    """
+    def __init__(self, db):
+        """
+        Borrows a connection from the pool of the shared Database, which resets the sessions left changed
+        :param db: shared Database
+        """
+        self.db = db
+        self.conn = db.pool.getconn()
+        self.cursor = self.conn.cursor()
         self.scanDict = {}
         self.joinDict = {}
         self.altQueryPlans = []
+        # (Total Cost, bitstring) of the cheapest distinct AQPs, the candidates measured with EXPLAIN ANALYZE
+        self.cheapestPlans = []
+        # EXPLAIN ANALYZE results of the QEP and of the cheapest AQPs, filled in by measurePlans
+        self.measurements = []
+        # why the plans were not measured, e.g. for a query that is not a SELECT, set by runStages
+        self.measurementError = None
         self.queryPlanList = []
+        self.aqpStats = {}
+        # (fingerprint, configuration, Total Cost) of every distinct plan found by AQPwrapper, the QEP included
+        self.distinctPlans = []
+        # seconds spent in each stage of analyse
+        self.timings = {}
+        # statistics version the plans of this analysis are cached under, read by checkStats
+        self.statsVersion = None
+        # plans explored and distinct plans found so far, read by background jobs to report progress
+        self.progress = {"explored": 0, "distinct": 0}
+        # EXPLAIN statements, AQPs found in the plan cache instead, statements sent and seconds spent waiting for
+        # the database and in its planner
+        self.counters = {"explains": 0, "cacheHits": 0, "roundTrips": 0, "roundTripTime": 0.0, "plannerTime": 0.0}
+        self.progressLock = threading.Lock()
+        # set once this analysis changes the session of its connection, e.g. with SET statements
+        self.dirty = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Returns the borrowed connection to the pool
+        :return: None
+        """
+        if self.conn is not None:
+            self.cursor.close()
+            self.db.pool.putconn(self.conn, self.dirty)
+            self.conn = None
 
     def printQueryPlan(self):
         print(self.queryPlanList)
 
     def generateQueryPlan(self, qep):
         """
-        Recursively generates query plan
-        :param qep: Qeury Execution Plan
-        :return: None, annotation saved in self.queryPlanDict
+        Annotates every node of a QEP in pre-order, the order the nodes are printed by EXPLAIN
+        :param qep: root PlanNode of the Qeury Execution Plan
+        :return: None, annotations saved in self.queryPlanList as (label, annotation) pairs
         """
-        if qep == {}:
-            return
+        annotate = self.db.annotation.annotate
+        append = self.queryPlanList.append
+        tree = qep.tree
+        # the nodes of a PlanTree are numbered in pre-order
+        for i in range(qep.index, tree.ends[qep.index]):
+            append(annotate(tree.node(i), self.scanDict, self.joinDict))
 
-        ##################### SCAN TYPE NODES #####################
-        if "Relation Name" in qep and qep["Relation Name"] in self.scanDict:
-            output = self.annotation.compareScanAnno(qep, self.scanDict)
-            self.queryPlanList.append([qep["Relation Name"].upper() + " table", output])
-
-        ##################### JOIN TYPE NODES #####################
-        # merge join type nodes
-        elif "Merge Cond" in qep and qep["Merge Cond"] in self.joinDict:
-            output = self.annotation.compareJoinAnno(qep, self.joinDict, qep["Merge Cond"])
-            self.queryPlanList.append([qep["Merge Cond"], output])
-
-        # hash join type nodes
-        elif "Hash Cond" in qep and qep["Hash Cond"] in self.joinDict:
-            output = self.annotation.compareJoinAnno(qep, self.joinDict, qep["Hash Cond"])
-            self.queryPlanList.append([qep["Hash Cond"], output])
-        
-        ##################### SORT TYPE NODES #####################
-        elif "Sort Key" in qep:
-            procedure = self.annotation.annoDict.get(qep["Node Type"], self.annotation.defaultAnno)
-            output = procedure(qep)
-            self.queryPlanList.append([qep["Sort Key"], output])
-
-        ################## OTHER TYPE OF NODES ###################
-        else:
-            procedure = self.annotation.annoDict.get(qep["Node Type"], self.annotation.defaultAnno)
-            output = procedure(qep)
-            self.queryPlanList.append([qep["Node Type"], output])
+    def runStages(self, query, timings):
+        """
+        Runs the stages shared by every analysis: validation, AQP enumeration, annotation and the opt-in
+        EXPLAIN ANALYZE measurement. A query that cannot be measured is still analysed, the reason is kept in
+        self.measurementError. The web pages render the results afterwards, analyse returns them as plain data.
+        :param query: SQL query
+        :param timings: receives the seconds spent in every stage
+        :return: QEP, None if the query is invalid
+        """
+        with stage(timings, "validate"):
+            if not self.checkValidQuery(query):
+                return None
+        with stage(timings, "enumerate"):
+            qep = self.query(query)
+        with stage(timings, "annotate"):
+            self.generateQueryPlan(qep["Plan"])
+        if self.db.measure:
+            with stage(timings, "measure"):
+                try:
+                    self.measurePlans(query, qep)
+                except ValueError as e:
+                    self.measurementError = str(e)
+        return qep
+
+    def analyse(self, query):
+        """
+        Runs the whole analysis of a query and returns its results as plain data, without the presentation of the
+        web pages: the QEP, the distinct AQPs with their fingerprints and configurations (the plans of the displayed
+        ones included), one record per QEP node with the compared alternatives (annotationRecords), the
+        EXPLAIN ANALYZE results if enabled, the time of every stage in milliseconds and the database counters.
+        :param query: SQL query
+        :return: dict that can be serialized as JSON
+        """
+        self.timings = {}
+        with stage(self.timings, "total"):
+            qep = self.runStages(query, self.timings)
+            result = {"query": query, "valid": qep is not None}
+            if qep is None:
+                result["error"] = INVALID_QUERY
+            else:
+                with stage(self.timings, "annotate"):
+                    displayed = {aqp.fingerprint: aqp for aqp in self.altQueryPlans}
+                    aqps = []
+                    for t, configuration, cost in sorted(self.distinctPlans, key=lambda plan: (plan[2], plan[0])):
+                        if configuration == 0:
+                            continue
+                        off, settings = self.db.describeConfiguration(configuration)
+                        aqp = {"fingerprint": t.hex(), "total_cost": cost, "off": off, "settings": settings}
+                        if t in displayed:
+                            aqp["plan"] = displayed[t].toPlan()
+                        aqps.append(aqp)
+                    result.update({
+                        "stats_version": self.statsVersion,
+                        "qep": {"fingerprint": qep.fingerprint.hex(), "total_cost": qep["Plan"]["Total Cost"],
+                                "plan": qep.toPlan()},
+                        "aqps": aqps,
+                        # fingerprints of the displayed AQPs, best first
+                        "displayed": [aqp.fingerprint.hex() for aqp in self.altQueryPlans],
+                        "annotations": self.annotationRecords(qep)
+                    })
+                if self.db.measure:
+                    if self.measurementError is None:
+                        result["measurements"] = self.measuredSummaries()
+                    else:
+                        result["measurement_error"] = self.measurementError
 
-        ##################### RECURSIVE CALL #####################
-        if "Plans" in qep:
-            for i in qep["Plans"]:
-                self.generateQueryPlan(i)
-    
+        result["stages"] = {name: round(seconds * 1000, 3) for name, seconds in self.timings.items()}
+        result["counters"] = {"explains": self.counters["explains"],
+                              "cache_hits": self.counters["cacheHits"],
+                              "explored": self.aqpStats.get("explained", 0),
+                              "pruned": self.aqpStats.get("saved", 0),
+                              "sampled": self.aqpStats.get("sampled", 0),
+                              "distinct": self.aqpStats.get("distinct", 0),
+                              "round_trips": self.counters["roundTrips"],
+                              "round_trip_ms": round(self.counters["roundTripTime"] * 1000, 3),
+                              "planner_ms": round(self.counters["plannerTime"] * 1000, 3)}
+        return result
+
+    def measuredSummaries(self):
+        """
+        Summarizes the EXPLAIN ANALYZE results of measurePlans
+        :return: list of dict with the flags turned off, the sampled settings, the estimated cost and the execution
+                 and planning time in milliseconds, or the error
+        """
+        summaries = []
+        for measured in self.measurements:
+            summary = {"off": measured["off"], "settings": measured["settings"], "cost": measured["cost"]}
+            if "error" in measured:
+                summary["error"] = measured["error"]
+            else:
+                summary["execution_ms"] = measured["plan"]["Execution Time"]
+                summary["planning_ms"] = measured["plan"]["Planning Time"]
+            summaries.append(summary)
+        return summaries
+
+    def annotationRecords(self, qep):
+        """
+        Describes every node of a QEP in pre-order, the order of generateQueryPlan. Nodes are numbered by their
+        position and refer to their parent. Scans and joins found in scanDict and joinDict also list the cheapest
+        cost of every other node type on the same relation or join condition, with its ratio to the cost of the
+        node (the operator cost for joins, as in the annotations).
+        :param qep: QEP PlanTree
+        :return: list of dict
+        """
+        parents = [None] * len(qep)
+        for i in range(len(qep)):
+            for child in qep.children(i):
+                parents[child] = i
+        records = []
+        for i, nodeType in enumerate(qep.types):
+            record = {"node": i, "parent": parents[i], "type": nodeType, "startup_cost": qep.startupCosts[i],
+                      "total_cost": qep.totalCosts[i], "rows": qep.planRows[i]}
+            if qep.relations[i] is not None:
+                record["relation"] = qep.relations[i]
+            if qep.conditions[i] is not None:
+                record["condition"] = qep.conditions[i]
+            kind = NODE_TYPES.get(nodeType, UNKNOWN_NODE)[0]
+            seen = None
+            if kind == SCAN_NODE:
+                seen, cost = self.scanDict.get(qep.relations[i]), qep.totalCosts[i]
+            elif kind == JOIN_NODE:
+                seen, cost = self.joinDict.get(qep.conditions[i]), operatorCost(qep.node(i))
+            if seen:
+                record["compared_cost"] = cost
+                record["alternatives"] = [{"type": t, "cost": c, "ratio": c / cost if cost else None}
+                                          for t, c in sorted(seen.items(), key=lambda item: item[1]) if t != nodeType]
+            records.append(record)
+        return records
 
     def checkValidQuery(self, query):
         """
-        Tries to execute query and check for vaildity. Returns a single row on valid query. Else returns None
+        Checks the query for validity. With validation mode "explain" the query is only planned, so syntax
+        and semantics are checked without executing it, and the plan is cached for the following query call.
+        With validation mode "execute" the query is executed. Input holding more than one statement is invalid in
+        both modes. Returns a single row on valid query. Else returns None
         :param query:
         :return:
         """
+        if not isSingleStatement(query):
+            return None
         try:
-            self.cursor.execute(query)
-            results = self.cursor.fetchone()
-            return results
-        except Exception as e:
-            self.cursor.execute("ROLLBACK")
+            if self.db.validation == "execute":
+                # the statement may change the session, e.g. a SET
+                self.dirty = True
+                self.cursor.execute(query)
+                results = self.cursor.fetchone()
+                return results
+            self.checkStats()
+            return [self.defaultPlan(query)]
+        except Exception:
+            # in autocommit mode a failed statement leaves no transaction to roll back, and a connection broken
+            # by the failure is closed by the pool before it would be lent again
             return None
 
-
     def query(self, query):
         """
         Executes query and returns the qep.
@@ -112,145 +556,487 @@ class Database:
         :return: QEP, scanDict, joinDict
         """
 
-        self.cursor.execute("EXPLAIN (FORMAT JSON)" + query)
-        qep = self.cursor.fetchall()[0][0][0]
+        # the statistics version is read once per analysis, checkValidQuery already read it when planning the query
+        if self.statsVersion is None:
+            self.checkStats()
+        qep = self.defaultPlan(query)
 
         self.processPlans(qep["Plan"])
         self.AQPwrapper(query)
         return qep
 
+    def defaultPlan(self, query):
+        """
+        Returns the qep generated with the default planner method configuration, from the plan cache if possible.
+        :param query: SQL query to explain
+        :return: QEP
+        """
+        key = self.db.cache.makeKey(self.db.db_name, self.statsVersion, self.db.cache.queryDigest(query), 0)
+        qep = self.db.cache.get(key)
+        if qep is None:
+            qep = PlanTree(self.roundTrip(self.cursor, "EXPLAIN (SUMMARY, FORMAT JSON)" + query)[0][0][0])
+            self.countPlans([qep])
+            self.db.cache.put(key, qep)
+        return qep
+
     def AQPwrapper(self, query):
         """
-        Generates all possible combinations of AQPs
+        Generates all possible combinations of AQPs, then the AQPs of the configurations sampled from the search
+        space. Every distinct AQP is folded into scanDict and joinDict and offered to the selection of displayed
+        AQPs as it arrives, only the selected AQPs are held on to.
         :param query: query to be executed
         :return: None
         """
-        temp = set()
-        output = list()
-        encode = {
-            1: "OFF",
-            0: "ON"
-        }
-        # encodes each possible combination as a bitstring, 1==OFF, 0==ON
-        # MSB = enable_bitmapscan, LSB = enable_tidscan
-        for bitstring in range(2048):
-            setQuery = f"SET enable_bitmapscan={encode[(bitstring&1024)>>10]}; " \
-                       f"SET enable_hashagg={encode[(bitstring&512)>>9]}; " \
-                       f"SET enable_hashjoin={encode[(bitstring&256)>>8]}; " \
-                       f"SET enable_indexscan={encode[(bitstring&128)>>7]}; " \
-                       f"SET enable_indexonlyscan={encode[(bitstring&64)>>6]}; " \
-                       f"SET enable_material={encode[(bitstring&32)>>5]}; " \
-                       f"SET enable_mergejoin={encode[(bitstring&16)>>4]}; " \
-                       f"SET enable_nestloop={encode[(bitstring&8)>>3]}; " \
-                       f"SET enable_seqscan={encode[(bitstring&4)>>2]}; " \
-                       f"SET enable_sort={encode[(bitstring&2)>>1]}; " \
-                       f"SET enable_tidscan={encode[bitstring&1]};"
-
-            aqp = self.aqp(query, setQuery)
-            t = json.dumps(aqp)
-            if t not in temp:
-                if bitstring <= 6:
-                    self.altQueryPlans.append(aqp)
-                temp.add(t)
-                output.append(aqp)
+        temp = {}  # fingerprint -> lowest bitstring, or first sampled configuration, that produced the plan
+        costs = {}  # fingerprint -> Total Cost of the plan
+        # the QEP was explained by query, this is a plan cache hit
+        selection = PlanSelection(self.defaultPlan(query), self.db.displayPlans, self.db.rank)
+        explored = 0
+        sampled = 0
+        combinations = 2 ** len(self.db.possible)
+        if self.db.search == "exhaustive":
+            plans = ((b, aqp.fingerprint, aqp)
+                     for b, aqp in self.explainBitstrings(query, range(combinations)))
+        else:
+            plans = self.prunedSearch(query)
+        samples = ((c, aqp.fingerprint, aqp)
+                   for c, aqp in self.explainBitstrings(query, self.db.searchSpace.configurations))
+        for configuration, t, aqp in chain(plans, samples):
+            if isinstance(configuration, int):
+                explored += 1
+            else:
+                sampled += 1
+            first = temp.get(t)
+            if first is None:
+                temp[t] = configuration
+                costs[t] = aqp["Plan"]["Total Cost"]
+                self.processPlans(aqp["Plan"])
+                selection.offer(t, aqp)
+                self.progress["distinct"] = len(temp)
+            elif isinstance(configuration, int) and configuration < first:
+                # the sampled configurations come after every combination, they never replace a bitstring
+                temp[t] = configuration
+        self.altQueryPlans.extend(selection.plans())
+        self.distinctPlans = [(t, c, costs[t]) for t, c in temp.items()]
+        # the plan first produced by bitstring 0 is the QEP
+        self.cheapestPlans = heapq.nsmallest(self.db.measurePlans, ((costs[t], c) for t, c in temp.items() if c != 0),
+                                             key=lambda candidate: candidate[0])
+        self.aqpStats = {"explained": explored,
+                         "saved": combinations - explored,
+                         "sampled": sampled,
+                         "distinct": len(temp)}
 
         self.resetState()
-        for i in output:
-            self.processPlans(i["Plan"])
 
-    def aqp(self, query, setQuery):
+    def prunedSearch(self, query):
+        """
+        Explores the planner method combinations breadth first from the default plan. Only flags whose
+        node types appear in a plan found so far are turned off, and only combinations that produced a
+        new plan are expanded further. The search stops once a level yields no new plan.
+        :param query: query to be executed
+        :return: generator of (bitstring, fingerprint, aqp)
+        """
+        last = len(self.db.possible) - 1
+        flagBits = {node: 1 << (last - i)
+                    for i, flag in enumerate(self.db.possible) for node in self.db.flagNodes[flag]}
+        seen = set()
+        relevant = 0
+        frontier = [0]
+        visited = {0}
+        while frontier:
+            level = []
+            for bitstring, aqp in self.explainBitstrings(query, frontier):
+                t = aqp.fingerprint
+                level.append((bitstring, t, self.db.planNodeTypes(aqp)))
+                yield bitstring, t, aqp
+
+            # decide the expansions in bitstring order so that the search does not depend on arrival order
+            expand = []
+            for bitstring, t, nodes in sorted(level, key=lambda entry: entry[0]):
+                if t not in seen:
+                    seen.add(t)
+                    expand.append(bitstring)
+                    for node in nodes:
+                        relevant |= flagBits.get(node, 0)
+
+            bits = [1 << i for i in range(last + 1) if relevant & (1 << i)]
+            frontier = sorted({b | bit for b in expand for bit in bits} - visited)
+            visited.update(frontier)
+
+    def explainBitstrings(self, query, bitstrings):
+        """
+        Generates the AQP of every given combination of planner method configuration, or of every sampled
+        configuration, cached plans first and then the explained ones as each batch completes.
+        With more than one worker configured, the batches are spread over the connection
+        pool and every worker keeps its own planner settings.
+        :param query: query to be executed
+        :param bitstrings: encoded combinations, or sampled configurations, to explain
+        :return: generator of (bitstring, aqp), in no particular order
+        """
+        digest = self.db.cache.queryDigest(query)
+        keys = {b: self.db.cache.makeKey(self.db.db_name, self.statsVersion, digest, b) for b in bitstrings}
+        missing = []
+        for b in sorted(keys):
+            aqp = self.db.cache.get(keys[b])
+            if aqp is None:
+                missing.append(b)
+            else:
+                self.count(cacheHits=1)
+                self.advance(1)
+                yield b, aqp
+
+        for explained in self.explainMissing(query, missing):
+            self.db.cache.putMany([(keys[b], aqp) for b, aqp in explained])
+            yield from explained
+
+    def explainMissing(self, query, bitstrings):
+        """
+        Runs the EXPLAIN of every given combination against the database, bypassing the plan cache
+        :param query: query to be executed
+        :param bitstrings: sorted encoded combinations to explain
+        :return: generator of lists of (bitstring, aqp), one list per completed batch
+        """
+        chunks = [bitstrings[i:i + self.db.batch] for i in range(0, len(bitstrings), self.db.batch)]
+        if self.db.workers <= 1 or len(bitstrings) <= 1:
+            for chunk in chunks:
+                yield self.explainChunk(self.cursor, query, chunk)
+            return
+
+        def worker(chunk):
+            conn = self.db.workerPool.getconn()
+            try:
+                with conn.cursor() as cursor:
+                    return self.explainChunk(cursor, query, chunk)
+            finally:
+                # sampled configurations SET settings that the flag combinations do not set again
+                self.db.workerPool.putconn(conn, self.db.probe != "function"
+                                           and not all(isinstance(c, int) for c in chunk))
+
+        # split into smaller batches so that the workers stay busy and results stream back early
+        size = max(1, min(self.db.batch, -(-len(bitstrings) // (self.db.workers * 4))))
+        chunks = [bitstrings[i:i + size] for i in range(0, len(bitstrings), size)]
+        with ThreadPoolExecutor(max_workers=self.db.workers) as executor:
+            for future in as_completed([executor.submit(worker, chunk) for chunk in chunks]):
+                yield future.result()
+
+    def explainChunk(self, cursor, query, bitstrings):
+        """
+        Explains the given combinations on one connection using the configured probe mode
+        :param cursor: cursor of the connection to use
+        :param query: query to be executed
+        :param bitstrings: encoded combinations to explain
+        :return: list of (bitstring, aqp), in the order given
+        """
+        if self.db.probe != "function" and cursor is self.cursor:
+            # SET statements on the analyzer's own connection. Worker connections are only marked by
+            # explainMissing for sampled configurations, every flag combination sets all flags
+            self.dirty = True
+        if self.db.probe == "single":
+            return [(b, self.aqp(query, self.db.settingsQuery(b), cursor)) for b in bitstrings]
+
+        if self.db.probe == "pipelined":
+            results = []
+            for b in bitstrings:
+                # the SET statements and the EXPLAIN share one round trip, only the EXPLAIN result is returned
+                aqp = PlanTree(self.roundTrip(cursor, self.db.settingsQuery(b) + " EXPLAIN (SUMMARY, FORMAT JSON)" + query)[0][0][0])
+                self.countPlans([aqp])
+                results.append((b, aqp))
+                self.advance(1)
+            return results
+
+        results = []
+        text = query.strip().rstrip(";")
+        for i in range(0, len(bitstrings), self.db.batch):
+            batch = bitstrings[i:i + self.db.batch]
+            settings = json.dumps([self.db.configurationMap(b) for b in batch])
+            try:
+                rows = self.roundTrip(cursor, "SELECT idx, plan FROM pg_temp.aqp_probe(%s, %s)", (text, settings))
+            except (psycopg2.errors.UndefinedFunction, psycopg2.errors.InvalidSchemaName):
+                # temporary functions live per session, create it on first use of this connection
+                self.roundTrip(cursor, PROBE_FUNCTION)
+                rows = self.roundTrip(cursor, "SELECT idx, plan FROM pg_temp.aqp_probe(%s, %s)", (text, settings))
+            plans = [(batch[idx], PlanTree(plan[0])) for idx, plan in rows]
+            self.countPlans([aqp for _, aqp in plans])
+            results.extend(plans)
+            self.advance(len(batch))
+        return results
+
+    def aqp(self, query, setQuery, cursor=None):
         """
         Executes query and returns the aqp.
         :param query: query to be executed
         :param setQuery: Combination of planner method configuration
+        :param cursor: cursor to use, defaults to self.cursor
         :return: aqp
         """
-        self.cursor.execute(setQuery)
+        if cursor is None:
+            cursor = self.cursor
+        if cursor is self.cursor:
+            self.dirty = True
+        self.roundTrip(cursor, setQuery)
 
-        self.cursor.execute("EXPLAIN (FORMAT JSON)" + query)
-        aqp = self.cursor.fetchall()[0][0][0]
+        aqp = PlanTree(self.roundTrip(cursor, "EXPLAIN (SUMMARY, FORMAT JSON)" + query)[0][0][0])
+        self.countPlans([aqp])
+        self.advance(1)
         return aqp
 
+    def measurePlans(self, query, qep):
+        """
+        Runs EXPLAIN (ANALYZE, BUFFERS) on the QEP and on the cheapest distinct AQPs found by AQPwrapper, one after
+        another so that the plans do not compete with each other. Every execution runs in a read only transaction
+        with the [analyze] timeout, and at most [analyze] concurrency executions run at the same time in the process.
+        The QEP annotations in self.queryPlanList are extended with the measured time, rows and buffers of each node.
+        :param query: SELECT query, it is executed once per plan
+        :param qep: QEP returned by query
+        :return: None, results saved in self.measurements
+        """
+        if FIRST_KEYWORD.match(query).group(1).upper() not in ("SELECT", "WITH", "TABLE", "VALUES"):
+            raise ValueError("EXPLAIN ANALYZE executes the query, only SELECT queries are measured")
+        # a second statement, e.g. after a COMMIT ending the read only transaction, would run outside of it
+        if not isSingleStatement(query):
+            raise ValueError("EXPLAIN ANALYZE executes the query, only single statements are measured")
+        self.measurements = []
+        for cost, bitstring in [(qep["Plan"]["Total Cost"], 0)] + self.cheapestPlans:
+            off, settings = self.db.describeConfiguration(bitstring)
+            # settings are the sampled settings besides the flags, empty for combinations of flags
+            result = {"bitstring": bitstring if isinstance(bitstring, int) else None, "off": off, "settings": settings,
+                      "cost": cost}
+            try:
+                result["plan"] = self.measurePlan(query, bitstring)
+            except psycopg2.errors.QueryCanceled:
+                result["error"] = f"cancelled after the {self.db.measureTimeout} ms timeout"
+            except psycopg2.Error as e:
+                result["error"] = str(e).strip()
+            self.measurements.append(result)
+
+        measured = self.measurements[0].get("plan")
+        if measured is not None:
+            nodes = self.preorder(measured["Plan"])
+            # the executed QEP is planned again, its nodes only line up with the annotations if the plan is the same
+            if [node["Node Type"] for node in nodes] == [node["Node Type"] for node in self.preorder(qep["Plan"])] \
+                    and len(nodes) == len(self.queryPlanList):
+                actualAnno = self.db.annotation.actualAnno
+                self.queryPlanList = [(label, text + actualAnno(node))
+                                      for (label, text), node in zip(self.queryPlanList, nodes)]
+
+    def preorder(self, plan):
+        """
+        Lists the nodes of a plan in pre-order, the order of generateQueryPlan
+        :param plan: root node
+        :return: list of nodes
+        """
+        nodes = []
+        stack = [plan]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.get("Plans", [])))
+        return nodes
+
+    def measurePlan(self, query, bitstring):
+        """
+        Executes the query with one combination of planner method configuration under EXPLAIN ANALYZE. The settings
+        and the timeout are local to a read only transaction that is rolled back, so writes fail and the session
+        of the pooled connection is left as it was. The query is sent together with the transaction, so it must
+        be a single statement, as checked by measurePlans.
+        :param query: query to be executed
+        :param bitstring: encoded combination or sampled configuration
+        :return: EXPLAIN ANALYZE result
+        """
+        with self.db.measureSlots:
+            try:
+                plan = self.roundTrip(self.cursor, f"BEGIN READ ONLY; SET LOCAL statement_timeout={self.db.measureTimeout}; "
+                                                   + self.db.settingsQuery(bitstring, local=True)
+                                                   + " EXPLAIN (ANALYZE, BUFFERS, SUMMARY, FORMAT JSON)" + query)[0][0][0]
+            finally:
+                self.roundTrip(self.cursor, "ROLLBACK")
+        self.countPlans([plan])
+        return plan
+
+    def roundTrip(self, cursor, statement, params=None):
+        """
+        Sends a statement to the database and fetches its rows, counting the round trip and its duration
+        :param cursor: cursor of the connection to use
+        :param statement: SQL statement
+        :param params: statement parameters
+        :return: list of rows, empty for statements without result
+        """
+        start = time.perf_counter()
+        try:
+            cursor.execute(statement, params)
+            return cursor.fetchall() if cursor.description else []
+        finally:
+            self.count(roundTrips=1, roundTripTime=time.perf_counter() - start)
+
+    def countPlans(self, plans):
+        """
+        Counts explained plans and the planning time the database reports for them
+        :param plans: EXPLAIN results
+        :return: None
+        """
+        self.count(explains=len(plans), plannerTime=sum(plan.get("Planning Time", 0) for plan in plans) / 1000)
+
+    def count(self, **amounts):
+        """
+        Adds to the counters, safe to call from the AQP worker threads
+        :param amounts: counter name -> amount
+        :return: None
+        """
+        with self.progressLock:
+            for name, amount in amounts.items():
+                self.counters[name] += amount
+
+    def advance(self, explored):
+        """
+        Counts plans explored, safe to call from the AQP worker threads
+        :param explored: number of plans explored since the last call
+        :return: None
+        """
+        with self.progressLock:
+            self.progress["explored"] += explored
+
     def processPlans(self, qep):
         """
-        Recursively grab all the scans, merge join and hash join type nodes in a QEP/AQP which can be used for comparison later.
-        :param qep: generated qep
+        Folds the scan and join nodes of a QEP/AQP, as classified by annotation.NODE_TYPES, into the per relation
+        and per join condition minimum cost of every node type, which are used for comparison later.
+        The node fields are read from the arrays of the PlanTree.
+        :param qep: root PlanNode of the generated qep
         :return: None.
         """
-        if qep == {}:
-            return
+        tree = qep.tree
+        for i in range(qep.index, tree.ends[qep.index]):
+            nodeType = tree.types[i]
+            kind = NODE_TYPES.get(nodeType, UNKNOWN_NODE)[0]
 
-        #################### SCAN TYPE NODES ####################
-        # grabbing scan type nodes
-        if "Relation Name" in qep and qep["Relation Name"] in self.scanDict:
-            if qep not in self.scanDict[qep["Relation Name"]]:
-                self.scanDict[qep["Relation Name"]].append(qep)
-        elif "Relation Name" in qep and qep["Relation Name"] not in self.scanDict:
-            self.scanDict[qep["Relation Name"]] = [qep]
-
-        #################### JOIN TYPE NODES ####################
-        # for join types, minus off the total cost from the left and right child.
-
-        # grabbing merge join type nodes
-        if "Node Type" in qep and qep["Node Type"] == "Merge Join":
-            temp = qep.copy()
-            temp["Total Cost"] -= (temp["Plans"][0]["Total Cost"] + temp["Plans"][1]["Total Cost"])
-            temp.pop("Plans")
-            if temp["Merge Cond"] in self.joinDict:
-                if temp not in self.joinDict[temp["Merge Cond"]]:
-                    self.joinDict[temp["Merge Cond"]].append(temp)
-            else:
-                self.joinDict[temp["Merge Cond"]] = [temp]
-
-        # grabbing hash join type nodes
-        if "Node Type" in qep and qep["Node Type"] == "Hash Join":
-            temp = qep.copy()
-            temp["Total Cost"] -= (temp["Plans"][0]["Total Cost"] + temp["Plans"][1]["Total Cost"])
-            temp.pop("Plans")
-            if temp["Hash Cond"] in self.joinDict:
-                if temp not in self.joinDict[temp["Hash Cond"]]:
-                    self.joinDict[temp["Hash Cond"]].append(temp)
-            else:
-                self.joinDict[temp["Hash Cond"]] = [temp]
+            #################### SCAN TYPE NODES ####################
+            if kind == SCAN_NODE:
+                self.keepCheapest(self.scanDict.setdefault(tree.relations[i], {}), nodeType, tree.totalCosts[i])
 
-    
-        #################### RECURSIVE CALL ####################
-        if "Plans" in qep:
-            for i in qep["Plans"]:
-                self.processPlans(i)
+            #################### JOIN TYPE NODES ####################
+            # for join types, minus off the total cost of the inputs
+            elif kind == JOIN_NODE:
+                self.keepCheapest(self.joinDict.setdefault(tree.conditions[i], {}), nodeType, operatorCost(tree.node(i)))
 
-    def retrieveAllDbs(self):
-        self.cursor.execute("SELECT datname FROM pg_database")
-        dbs = self.cursor.fetchall()
-        db_list = []
-        for db in dbs:
-            db_list.append(db[0])
+    def keepCheapest(self, summary, nodeType, cost):
+        """
+        Records the cost of a node type if it is the cheapest seen so far
+        :param summary: node type -> minimum cost
+        :param nodeType: node type
+        :param cost: cost of the node
+        :return: None
+        """
+        if nodeType not in summary or cost < summary[nodeType]:
+            summary[nodeType] = cost
 
-        return db_list
-        
-    def closeConnection(self):
+    def checkStats(self):
         """
-        Close connection to database
+        Reads the statistics version of the database: the version recorded by the provisioning step of the loader
+        if the database has one, and the ANALYZE counters of pg_stat_user_tables. Cached plans generated
+        before the last ANALYZE are dropped.
         :return: None
         """
-        self.cursor.close()
-        self.conn.close()
+        if self.db.statsTable is None:
+            self.db.statsTable = self.roundTrip(self.cursor, "SELECT to_regclass('public.stats_version') IS NOT NULL")[0][0]
+        recorded = "(SELECT max(version) FROM public.stats_version)" if self.db.statsTable else "NULL"
+        version, count, last = self.roundTrip(self.cursor, f"SELECT {recorded}, "
+                                                           "coalesce(sum(analyze_count + autoanalyze_count), 0), "
+                                                           "max(greatest(last_analyze, last_autoanalyze)) FROM pg_stat_user_tables")[0]
+        self.statsVersion = f"{version}:{count}@{last}"
+        self.db.cache.checkVersion(self.db.db_name, self.statsVersion)
 
     def resetState(self):
         """
-        Resets the state of the database planner method configuration.
+        Restores the session defaults of the planner method configuration if this analysis changed them, so that
+        following EXPLAINs on the connection see the default configuration again.
+        :return: None
+        """
+        if self.dirty:
+            self.roundTrip(self.cursor, "RESET ALL")
+            self.dirty = False
+
+
+class PlanSelection:
+    """
+    Bounded selection of the AQPs shown next to the QEP, fed with every distinct AQP while the enumeration
+    streams them in. Only the k best plans are kept, in a heap whose root is the worst of them, so selecting
+    from n plans takes O(n log k) time and O(k) memory. Plans with the cost of the QEP or of an already selected
+    plan, and plans with the same nodes as the QEP, show nothing new and are not selected.
+    """
+    def __init__(self, qep, k, rank="cost"):
+        """
+        Starts an empty selection
+        :param qep: QEP the alternatives are compared with
+        :param k: number of plans selected
+        :param rank: "cost" prefers the cheapest plans, "distance" the plans differing from the QEP in the most
+                     nodes, then the cheapest
+        """
+        self.k = k
+        self.rank = rank
+        self.qepCost = qep["Plan"]["Total Cost"]
+        self.qepShape = self.shape(qep)
+        # (order, plan), better plans have higher orders, so heap[0] is the worst selected plan
+        self.heap = []
+        # Total Cost -> heap entry of the selected plan with that cost
+        self.costs = {}
+
+    @staticmethod
+    def shape(tree):
+        """
+        Structure of a plan, compared to find how far apart two plans are
+        :param tree: PlanTree
+        :return: Counter of (node type, relation)
+        """
+        return Counter(zip(tree.types, tree.relations))
+
+    def distance(self, tree):
+        """
+        Number of nodes, by node type and relation, that a plan has and the QEP has not or the other way round
+        :param tree: PlanTree
+        :return: structural distance from the QEP
+        """
+        shape = self.shape(tree)
+        return sum((shape - self.qepShape).values()) + sum((self.qepShape - shape).values())
+
+    def offer(self, fingerprint, aqp):
+        """
+        Considers a distinct AQP for the selection
+        :param fingerprint: fingerprint of the plan, breaks ties between equally ranked plans
+        :param aqp: PlanTree
         :return: None
         """
-        # restore to default (all ON)
-        setQuery = f"SET enable_bitmapscan=ON; " \
-                   f"SET enable_hashagg=ON; " \
-                   f"SET enable_hashjoin=ON; " \
-                   f"SET enable_indexscan=ON; " \
-                   f"SET enable_indexonlyscan=ON; " \
-                   f"SET enable_material=ON; " \
-                   f"SET enable_mergejoin=ON; " \
-                   f"SET enable_nestloop=ON; " \
-                   f"SET enable_seqscan=ON; " \
-                   f"SET enable_sort=ON; " \
-                   f"SET enable_tidscan=ON;"
-        self.cursor.execute(setQuery)
+        cost = aqp.totalCosts[0]
+        if self.k <= 0 or cost == self.qepCost:
+            return
+        tie = -int.from_bytes(fingerprint, "big")
+        if self.rank == "cost":
+            order = (-cost, tie)
+            # most plans are rejected by cost alone, before their structure is compared
+            if len(self.heap) >= self.k and cost not in self.costs and order <= self.heap[0][0]:
+                return
+            if self.distance(aqp) == 0:
+                return
+        else:
+            distance = self.distance(aqp)
+            if distance == 0:
+                return
+            order = (distance, -cost, tie)
+        entry = (order, aqp)
+        same = self.costs.get(cost)
+        if same is not None:
+            if entry[0] <= same[0]:
+                return
+            self.heap.remove(same)
+            heapq.heapify(self.heap)
+        elif len(self.heap) >= self.k:
+            if entry[0] <= self.heap[0][0]:
+                return
+            del self.costs[heapq.heappop(self.heap)[1].totalCosts[0]]
+        heapq.heappush(self.heap, entry)
+        self.costs[cost] = entry
+
+    def plans(self):
+        """
+        Lists the selected plans, best first
+        :return: list of PlanTree
+        """
+        return [aqp for _, aqp in sorted(self.heap, key=lambda entry: entry[0], reverse=True)]
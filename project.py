@@ -1,5 +1,9 @@
 from interface import FlaskApp
 
+def create_app():
+    """Returns the Flask application for WSGI servers, e.g. gunicorn "project:create_app()" """
+    return FlaskApp().app
+
 def main():
     app = FlaskApp()
     app.run()
@@ -0,0 +1,250 @@
+import json
+import re
+import threading
+
+import psycopg2
+
+from plancache import PlanCache
+
+SET_PATTERN = re.compile(r"SET\s+(\w+)\s*=\s*'?([\w.]+)'?\s*;", re.IGNORECASE)
+RESET_PATTERN = re.compile(r"\bRESET\s+ALL\b", re.IGNORECASE)
+EXPLAIN_PATTERN = re.compile(r"EXPLAIN\s*\([^)]*FORMAT JSON\)\s*(.*)$", re.IGNORECASE | re.DOTALL)
+
+
+class ExplainRecording:
+    """
+    EXPLAIN results keyed by normalized query and planner method configuration. A recording is made by running
+    the analysis on connections from recordingConnection, and replayed without a server through replayConnection.
+    """
+    def __init__(self, path=None):
+        """
+        Creates an empty recording, or loads one saved with save
+        :param path: JSON file of a saved recording
+        """
+        self.plans = {}
+        # rows of the other statements returning a result, e.g. the statistics version, by statement text
+        self.results = {}
+        self.explains = 0
+        self.lock = threading.Lock()
+        # normalizing is slow compared to a lookup, every query is normalized once
+        self.normalized = {}
+        if path:
+            with open(path) as f:
+                saved = json.load(f)
+            self.plans = saved["plans"]
+            self.results = saved.get("results", {})
+
+    @staticmethod
+    def settingsKey(settings):
+        """
+        Canonical form of a planner configuration: the sorted enable_* flags that are turned off, followed by the
+        sorted values of the other settings, e.g. sampled from the search space
+        :param settings: dict of setting to value
+        :return: settings key
+        """
+        off = sorted(k.lower() for k, v in settings.items()
+                     if k.lower().startswith("enable_") and str(v).upper() in ("OFF", "FALSE", "0"))
+        values = sorted(f"{k.lower()}={v}" for k, v in settings.items() if not k.lower().startswith("enable_"))
+        return ",".join(off + values)
+
+    def queryKey(self, query):
+        """
+        Normalized form of a query, as used by the plan cache
+        :param query: SQL query
+        :return: query key
+        """
+        key = self.normalized.get(query)
+        if key is None:
+            key = self.normalized[query] = PlanCache.normalize(query)
+        return key
+
+    def lookup(self, query, settings):
+        """
+        Returns the recorded EXPLAIN result of a query
+        :param query: SQL query
+        :param settings: planner method configuration in effect
+        :return: EXPLAIN result
+        """
+        self.count(1)
+        entry = self.plans.get(self.queryKey(query), {}).get(self.settingsKey(settings))
+        if entry is None:
+            raise psycopg2.ProgrammingError(f"no recorded plan for settings '{self.settingsKey(settings)}'")
+        if "error" in entry:
+            raise psycopg2.ProgrammingError(entry["error"])
+        # plans are kept as text and decoded on every lookup, like psycopg2 does with the server's reply
+        return json.loads(entry["plan"])
+
+    def record(self, query, settings, plan=None, error=None):
+        """
+        Records the EXPLAIN result of a query, or the error it raised
+        :param query: SQL query
+        :param settings: planner method configuration in effect
+        :param plan: EXPLAIN result
+        :param error: error message
+        :return: None
+        """
+        self.count(1)
+        entry = {"error": error} if error is not None else {"plan": json.dumps(plan)}
+        with self.lock:
+            self.plans.setdefault(self.queryKey(query), {})[self.settingsKey(settings)] = entry
+
+    def count(self, explains):
+        """
+        Counts EXPLAIN statements, safe to call from the AQP worker threads
+        :param explains: number of EXPLAIN statements run
+        :return: None
+        """
+        with self.lock:
+            self.explains += explains
+
+    def save(self, path):
+        """
+        Writes the recording to a JSON file
+        :param path: file to write
+        :return: None
+        """
+        with open(path, "w") as f:
+            json.dump({"results": self.results, "plans": self.plans}, f)
+
+    def replayConnection(self):
+        """
+        Opens a connection answering from the recording
+        :return: connection
+        """
+        return ReplayConnection(self)
+
+    def recordingConnection(self, conn):
+        """
+        Wraps a live connection so that its EXPLAIN results are recorded
+        :param conn: psycopg2 connection
+        :return: connection
+        """
+        return RecordingConnection(self, conn)
+
+
+class ReplayConnection:
+    """
+    Connection answering the statements of the analysis from an ExplainRecording
+    """
+    def __init__(self, recording):
+        self.recording = recording
+        # session planner method configuration, changed by SET statements
+        self.settings = {}
+
+    def cursor(self):
+        return ReplayCursor(self)
+
+    def close(self):
+        pass
+
+
+class ReplayCursor:
+    """
+    Cursor of a ReplayConnection. Understands SET and RESET ALL statements, EXPLAIN (..., FORMAT JSON) and the probe function of
+    preprocessing, other statements are answered with the rows recorded for the same statement text.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        # like DB-API cursors, None after statements without a result
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def parse(self, sql, params=None):
+        """
+        Applies the SET statements of a statement to the session and finds the queries it explains
+        :param sql: statement
+        :param params: statement parameters
+        :return: kind of statement ("probe", "explain" or "other"), list of (query, settings) explained
+        """
+        if "pg_temp.aqp_probe(" in sql and sql.lstrip().upper().startswith("SELECT"):
+            query, settings = params
+            # set_config(..., true) lasts until the end of the statement, so the settings accumulate
+            current = dict(self.connection.settings)
+            explained = []
+            for s in json.loads(settings):
+                current.update(s)
+                explained.append((query, dict(current)))
+            return "probe", explained
+        if sql.lstrip().upper().startswith("CREATE"):
+            return "other", []
+        match = EXPLAIN_PATTERN.search(sql)
+        prefix = sql[:match.start()] if match else sql
+        if RESET_PATTERN.search(prefix):
+            self.connection.settings.clear()
+        for flag, value in SET_PATTERN.findall(prefix):
+            self.connection.settings[flag.lower()] = value
+        if match:
+            return "explain", [(match.group(1), dict(self.connection.settings))]
+        return "other", []
+
+    def execute(self, sql, params=None):
+        kind, explained = self.parse(sql, params)
+        recording = self.connection.recording
+        if kind == "probe":
+            self.rows = [(i, recording.lookup(query, settings)) for i, (query, settings) in enumerate(explained)]
+        elif kind == "explain":
+            self.rows = [(recording.lookup(*explained[0]),)]
+        else:
+            self.rows = [tuple(row) for row in recording.results.get(sql, [])]
+        self.description = [("result",)] if self.rows else None
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        pass
+
+
+class RecordingConnection(ReplayConnection):
+    """
+    Live connection whose EXPLAIN results are added to an ExplainRecording
+    """
+    def __init__(self, recording, conn):
+        super().__init__(recording)
+        self.conn = conn
+
+    def cursor(self):
+        return RecordingCursor(self, self.conn.cursor())
+
+    def close(self):
+        self.conn.close()
+
+
+class RecordingCursor(ReplayCursor):
+    """
+    Cursor of a RecordingConnection, runs every statement on the server
+    """
+    def __init__(self, connection, cursor):
+        super().__init__(connection)
+        self.cursor = cursor
+
+    def execute(self, sql, params=None):
+        kind, explained = self.parse(sql, params)
+        recording = self.connection.recording
+        try:
+            self.cursor.execute(sql, params)
+        except psycopg2.Error as e:
+            if kind == "explain":
+                recording.record(*explained[0], error=str(e).strip())
+            raise
+        self.description = self.cursor.description
+        self.rows = self.cursor.fetchall() if self.description else []
+        if kind == "probe":
+            for idx, plan in self.rows:
+                recording.record(*explained[idx], plan=plan)
+        elif kind == "explain":
+            recording.record(*explained[0], plan=self.rows[0][0])
+        elif self.rows:
+            recording.results[sql] = json.loads(json.dumps(self.rows, default=str))
+
+    def close(self):
+        self.cursor.close()
@@ -0,0 +1,93 @@
+import itertools
+import random
+
+# keys of the [search_space] section that configure the sampling instead of naming a setting
+OPTIONS = ("budget", "sampler", "seed")
+
+
+class SearchSpace:
+    """
+    Planner settings explored besides the combinations of enable_* flags, e.g. join_collapse_limit or work_mem.
+    Every setting has a grid of values, boolean settings simply have the grid on, off. A configuration is a tuple
+    of (setting, value) pairs sorted by setting. Since the grids multiply, at most budget configurations are
+    explained per query, sampled at random or by Latin hypercube sampling. The sample only depends on the grids
+    and the seed, so the same configurations are explained, and found in the plan cache, for every query.
+    """
+    def __init__(self, grids, budget=0, sampler="lhs", seed=0):
+        """
+        Defines the search space
+        :param grids: dict of setting to list of values, as accepted by SET
+        :param budget: maximum number of configurations explained per query, 0 disables the search
+        :param sampler: "lhs" samples every value of a grid about equally often, "random" samples uniformly
+        :param seed: seed of the sampler
+        """
+        if sampler not in ("lhs", "random"):
+            raise ValueError(f"unknown sampler '{sampler}', expected lhs or random")
+        self.grids = {setting: list(values) for setting, values in sorted(grids.items()) if values}
+        self.budget = budget if self.grids else 0
+        self.sampler = sampler
+        self.seed = seed
+        self.configurations = self.draw()
+
+    @classmethod
+    def fromConfig(cls, config, section="search_space"):
+        """
+        Reads the search space from a configuration section: budget, sampler and seed, and one comma separated
+        grid of values per setting, e.g. work_mem=1MB, 4MB, 64MB
+        :param config: ConfigParser
+        :param section: section name
+        :return: SearchSpace, empty if the section is missing
+        """
+        if not config.has_section(section):
+            return cls({})
+        grids = {setting: [value.strip() for value in values.split(",") if value.strip()]
+                 for setting, values in config.items(section) if setting not in OPTIONS}
+        return cls(grids,
+                   config.getint(section, "budget", fallback=0),
+                   config.get(section, "sampler", fallback="lhs"),
+                   config.getint(section, "seed", fallback=0))
+
+    def size(self):
+        """
+        Number of configurations of the full grid
+        :return: product of the grid sizes, 0 without settings
+        """
+        size = 1 if self.grids else 0
+        for values in self.grids.values():
+            size *= len(values)
+        return size
+
+    def draw(self):
+        """
+        Samples the configurations, the full grid if it fits in the budget
+        :return: list of configurations
+        """
+        size = self.size()
+        if self.budget <= 0 or size == 0:
+            return []
+        settings = list(self.grids)
+        if size <= self.budget:
+            return [tuple(zip(settings, values)) for values in itertools.product(*self.grids.values())]
+
+        rng = random.Random(self.seed)
+        if self.sampler == "random":
+            configurations = []
+            for index in rng.sample(range(size), self.budget):
+                # decode the index into one value per grid, the last grid varying fastest
+                values = []
+                for setting in reversed(settings):
+                    index, position = divmod(index, len(self.grids[setting]))
+                    values.append(self.grids[setting][position])
+                configurations.append(tuple(zip(settings, reversed(values))))
+            return configurations
+
+        # Latin hypercube: every grid is cut into budget strata holding its values in order, each stratum is used
+        # once, and the strata of the grids are combined in random order
+        columns = []
+        for setting in settings:
+            values = self.grids[setting]
+            column = [values[i * len(values) // self.budget] for i in range(self.budget)]
+            rng.shuffle(column)
+            columns.append(column)
+        # grids smaller than the budget repeat values, so two samples can coincide
+        return list(dict.fromkeys(tuple(zip(settings, values)) for values in zip(*columns)))
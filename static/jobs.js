@@ -0,0 +1,38 @@
+// Submits the query as a background job and follows its progress until the result page is ready.
+// Without JavaScript the form still posts to /queryplan directly.
+function submitJob(form) {
+  const progress = document.getElementById("jobProgress");
+  fetch("/jobs", { method: "POST", body: new FormData(form) })
+    .then((response) => response.json())
+    .then((job) => {
+      const show = (status) => {
+        progress.textContent =
+          "Plans explored: " + status.explored + ", distinct plans found: " + status.distinct;
+        if (status.state === "done" || status.state === "failed") {
+          window.location = job.result;
+          return true;
+        }
+        return false;
+      };
+      if (window.EventSource) {
+        const events = new EventSource(job.events);
+        events.onmessage = (message) => {
+          if (show(JSON.parse(message.data))) {
+            events.close();
+          }
+        };
+      } else {
+        const poll = () =>
+          fetch(job.status)
+            .then((response) => response.json())
+            .then((status) => {
+              if (!show(status)) {
+                setTimeout(poll, 500);
+              }
+            });
+        poll();
+      }
+    })
+    .catch(() => form.submit());
+  return false;
+}